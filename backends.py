@@ -0,0 +1,338 @@
+import time
+from array import array
+
+import pygame
+
+# Presentation backends for the CPU. The null backends keep the machine state
+# the CPU needs (the framebuffer) but never touch a display, an audio device
+# or the keyboard, so the emulator can run headless at interpreter speed.
+
+
+class NullVideo:
+    """
+    Owns the framebuffer without drawing it anywhere. The framebuffer is one
+    integer per scanline, pixel x of a row is bit (width-1-x).
+    """
+    def __init__(self, width, height):
+        self.width, self.height = width, height
+        self.pixels = [0] * height
+
+    def clear(self):
+        self.pixels = [0] * self.height
+
+    def resize(self, width, height):
+        """Switches resolution (SCHIP 00FE/00FF), which clears the screen."""
+        self.width, self.height = width, height
+        self.clear()
+
+    # SCHIP scrolling moves whole rows in the list and whole rows of bits in one shift each
+
+    def scroll_down(self, rows):
+        pixels = self.pixels
+        self.pixels = [0] * rows + pixels[:self.height - rows]
+
+    def scroll_right(self, columns):
+        self.pixels = [line >> columns for line in self.pixels]
+
+    def scroll_left(self, columns):
+        mask = (1 << self.width) - 1
+        self.pixels = [(line << columns) & mask for line in self.pixels]
+
+    def get_pixel(self, x, y):
+        return (self.pixels[y] >> (self.width-1-x)) & 1
+
+    def to_bytes(self):
+        """The framebuffer packed 8 pixels per byte, rows top to bottom."""
+        row_bytes = self.width // 8
+        return b''.join(line.to_bytes(row_bytes, 'big') for line in self.pixels)
+
+    def handle_event(self, event):
+        pass
+
+    def present(self):
+        """Shows the current framebuffer, called once per frame."""
+        pass
+
+
+class VideoSystem(NullVideo):
+    """
+    Presents the framebuffer through a native-resolution surface that is
+    rebuilt from the row integers in one go and scaled to the window once per
+    frame. Only the rectangles that changed since the last frame are pushed
+    to the display. The window can be resized and F11 toggles fullscreen.
+    """
+    def __init__(self, width, height, scale, screen, base_color, draw_color):
+        super().__init__(width, height)
+        self.screen_width, self.screen_height = self.width*scale, self.height*scale
+        self.scale = scale
+        self.base_color = base_color
+        self.draw_color = draw_color
+
+        if screen == None:
+            self.screen = pygame.display.set_mode((self.screen_width, self.screen_height), pygame.RESIZABLE)
+            self.owns_window = True
+        else:
+            self.screen = screen
+            self.owns_window = False
+
+        # RGB bytes for the 8 pixels of every possible framebuffer byte
+        off, on = bytes(base_color), bytes(draw_color)
+        self.byte_pixels = [b''.join(on if byte & (0x80 >> bit) else off for bit in range(8)) for byte in range(256)]
+
+        self.presented = None
+        self.layout()
+
+    def layout(self):
+        """Fits the framebuffer into the window, keeping its aspect ratio."""
+        window_width, window_height = self.screen.get_size()
+        self.scale = min(window_width / self.width, window_height / self.height)
+        self.screen_width = int(self.width * self.scale)
+        self.screen_height = int(self.height * self.scale)
+        self.offset_x = (window_width - self.screen_width) // 2
+        self.offset_y = (window_height - self.screen_height) // 2
+        self.layout_size = (self.width, self.height)
+        self.presented = None
+
+    def handle_event(self, event):
+        if event.type == pygame.VIDEORESIZE and self.owns_window:
+            self.screen = pygame.display.get_surface()
+            self.layout()
+        elif event.type == pygame.KEYDOWN and event.key == pygame.K_F11:
+            pygame.display.toggle_fullscreen()
+            self.screen = pygame.display.get_surface()
+            self.layout()
+
+    def present(self):
+        if self.layout_size != (self.width, self.height):
+            self.layout()
+
+        pixels = self.pixels
+        if self.presented is None:
+            self.screen.fill(self.base_color)
+            dirty = [self.screen.get_rect()]
+        else:
+            dirty = self.dirty_rects(self.presented, pixels)
+            if not dirty:
+                return
+
+        row_bytes = self.width // 8
+        byte_pixels = self.byte_pixels
+        data = b''.join(byte_pixels[byte] for line in pixels for byte in line.to_bytes(row_bytes, 'big'))
+        native = pygame.image.frombuffer(data, (self.width, self.height), 'RGB')
+        scaled = pygame.transform.scale(native, (self.screen_width, self.screen_height))
+        self.screen.blit(scaled, (self.offset_x, self.offset_y))
+        pygame.display.update(dirty)
+        self.presented = list(pixels)
+
+    def dirty_rects(self, old, new):
+        """Window rectangles around each run of changed rows, narrowed to the changed columns."""
+        rects = []
+        band_start = None
+        for y in range(self.height + 1):
+            diff = old[y] ^ new[y] if y < self.height else 0
+            if diff:
+                left = self.width - diff.bit_length()
+                right = self.width - (diff & -diff).bit_length()
+                if band_start is None:
+                    band_start, band_left, band_right = y, left, right
+                else:
+                    band_left, band_right = min(band_left, left), max(band_right, right)
+            elif band_start is not None:
+                rects.append(pygame.Rect(
+                    self.offset_x + int(band_left * self.scale),
+                    self.offset_y + int(band_start * self.scale),
+                    int((band_right - band_left + 1) * self.scale) + 1,
+                    int((y - band_start) * self.scale) + 1))
+                band_start = None
+        return rects
+
+
+class NullAudio:
+    def play(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def set_pattern(self, pattern, pitch):
+        """XO-CHIP audio: the 16 byte pattern to loop instead of the beep, and its pitch register. None is the beep."""
+        pass
+
+
+# The beep is a synthesized square wave rather than a decoded file, and the
+# mixer only starts the first time a ROM sets the sound timer. Sounds are
+# cached per mixer setting and shared by every CPU.
+
+beep_frequency = 440
+beep_volume = 0.25
+_sounds = {}
+
+def _start_mixer():
+    if not pygame.mixer.get_init():
+        pygame.mixer.init(frequency=44100, size=-16, channels=1, buffer=512)
+    return pygame.mixer.get_init()
+
+def _bit_sound(bits, bit_rate):
+    """A loopable Sound that plays a sequence of 1-bit samples at bit_rate bits per second."""
+    rate, _, channels = settings = _start_mixer()
+    key = (bytes(bits), bit_rate, settings)
+    sound = _sounds.get(key)
+    if sound is None:
+        if len(_sounds) > 64:
+            _sounds.clear()
+        level = int(32767 * beep_volume)
+        length = max(1, round(len(bits) * rate / bit_rate))
+        samples = array('h')
+        for i in range(length):
+            samples.extend([level if bits[int(i * bit_rate / rate) % len(bits)] else -level] * channels)
+        sound = _sounds[key] = pygame.mixer.Sound(buffer=samples.tobytes())
+    return sound
+
+def beep_sound():
+    # 22 whole periods, so the loop has no seam
+    return _bit_sound([1, 0] * 22, 2 * beep_frequency)
+
+def pattern_sound(pattern, pitch):
+    """XO-CHIP pattern audio, the 128 bits of `pattern` at 4000*2^((pitch-64)/48) bits per second."""
+    bits = [(byte >> (7 - bit)) & 1 for byte in pattern for bit in range(8)]
+    return _bit_sound(bits, 4000 * 2 ** ((pitch - 64) / 48))
+
+
+class PygameAudio(NullAudio):
+    def __init__(self):
+        self.sound = None       # made on the first play, so the mixer starts only when needed
+        self.pattern = None
+        self.playing = False
+
+    def play(self):
+        if not self.playing:
+            if self.sound is None:
+                self.sound = pattern_sound(*self.pattern) if self.pattern else beep_sound()
+            self.sound.play(-1)
+            self.playing = True
+
+    def stop(self):
+        if self.playing:
+            self.sound.stop()
+            self.playing = False
+
+    def set_pattern(self, pattern, pitch):
+        # a beep in progress picks the new pattern up on the next frame's play()
+        self.stop()
+        self.pattern = None if pattern is None else (bytes(pattern), pitch)
+        self.sound = None
+
+
+class NullInput:
+    """
+    No keys are ever pressed and no events ever arrive. Input backends keep
+    the held CHIP-8 keys in `keypad`, bit k set while key k is down, and
+    update it only in poll(). The CPU copies it once per frame. Backends
+    with an event queue note in `key_times` when each key's last event was
+    taken off it, by time.perf_counter().
+    """
+    keypad = 0
+    key_times = {}
+
+    def poll(self, cycle):
+        """
+        Samples the input once per frame, `cycle` is the CPU's instruction
+        count at that point. Returns the window events since the last poll.
+        """
+        return []
+
+    def wait_event(self, timeout):
+        """
+        Sleeps for up to `timeout` seconds while the CPU waits for a key.
+        Returns True when input arrived before the timeout.
+        """
+        time.sleep(timeout)
+        return False
+
+
+class ScriptedInput(NullInput):
+    """
+    Plays back a script of (frame, key, pressed) entries. Every poll() is one
+    frame, which is how often the CPU samples its input.
+    """
+    def __init__(self, script):
+        self.script = sorted(script)
+        self.frame = -1
+        self.position = 0
+        self.keypad = 0
+
+    def poll(self, cycle):
+        self.frame += 1
+        self.advance(self.frame)
+        return []
+
+    def advance(self, frame):
+        while self.position < len(self.script) and self.script[self.position][0] <= frame:
+            _, key, pressed = self.script[self.position]
+            if pressed:
+                self.keypad |= 1 << key
+            else:
+                self.keypad &= ~(1 << key)
+            self.position += 1
+
+
+class PygameInput(NullInput):
+    def __init__(self):
+        self.key_map = {
+            pygame.K_x: 0x0,  # 0
+            pygame.K_1: 0x1,  # 1
+            pygame.K_2: 0x2,  # 2
+            pygame.K_3: 0x3,  # 3
+            pygame.K_q: 0x4,  # 4
+            pygame.K_w: 0x5,  # 5
+            pygame.K_e: 0x6,  # 6
+            pygame.K_a: 0x7,  # 7
+            pygame.K_s: 0x8,  # 8
+            pygame.K_d: 0x9,  # 9
+            pygame.K_z: 0xA,  # A
+            pygame.K_c: 0xB,  # B
+            pygame.K_4: 0xC,  # C
+            pygame.K_r: 0xD,  # D
+            pygame.K_f: 0xE,  # E
+            pygame.K_v: 0xF   # F
+        }
+
+        self.pending = []   # events wait_event() took off the queue
+        self.keypad = 0
+        self.key_times = {}
+
+    def poll(self, cycle):
+        now = time.perf_counter()
+        queued = pygame.event.get()
+        events = self.pending + queued
+        self.pending = []
+        key_map = self.key_map
+        # events wait_event() took were timed as they arrived
+        for event in queued:
+            if event.type in (pygame.KEYDOWN, pygame.KEYUP) and event.key in key_map:
+                self.key_times[key_map[event.key]] = now
+        for event in events:
+            if event.type == pygame.KEYDOWN and event.key in key_map:
+                self.keypad |= 1 << key_map[event.key]
+            elif event.type == pygame.KEYUP and event.key in key_map:
+                self.keypad &= ~(1 << key_map[event.key])
+            elif event.type == pygame.WINDOWFOCUSLOST:
+                # the key ups go to another window
+                self.keypad = 0
+        return events
+
+    def wait_event(self, timeout):
+        # wakes for keys and quitting, other events are kept for the next poll
+        deadline = time.perf_counter() + timeout
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return False
+            event = pygame.event.wait(max(1, int(remaining * 1000)))
+            if event.type == pygame.NOEVENT:
+                return False
+            self.pending.append(event)
+            if event.type in (pygame.KEYDOWN, pygame.KEYUP) and event.key in self.key_map:
+                self.key_times[self.key_map[event.key]] = time.perf_counter()
+            if event.type in (pygame.KEYDOWN, pygame.KEYUP, pygame.QUIT):
+                return True
@@ -0,0 +1,193 @@
+import os
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import argparse
+import contextlib
+import io
+import json
+import platform
+import sys
+import time
+
+from backends import ScriptedInput
+from conformance import game_script, scripts
+from emulator import CPU, default_quirks
+
+# Micro benchmarks time every opcode family through CPU.execute_opcode and
+# draw_sprite with the clipping and wrapping quirks, the dispatch table
+# handlers whichever engine is chosen. Macro benchmarks run real ROMs headless
+# on the chosen engine for a fixed number of instructions, long enough to
+# take a second or more, and keep the best of a few runs. Idle loops are
+# stepped rather than fast-forwarded there, so every counted instruction ran.
+#
+#   python benchmark.py --output bench.json
+#   python benchmark.py --baseline bench.json --threshold 0.1
+
+macro_roms = ['games/BRIX', 'games/TETRIS', 'tests/3-corax+.ch8']
+
+# one representative opcode per family, I points at scratch memory and V0-VF hold small values
+opcode_families = {
+    '00E0': 0x00E0, '00EE': 0x00EE, '1nnn': 0x1300, '2nnn': 0x2300,
+    '3xkk': 0x3112, '4xkk': 0x4112, '5xy0': 0x5120, '6xkk': 0x6112, '7xkk': 0x7112,
+    '8xy0': 0x8120, '8xy1': 0x8121, '8xy2': 0x8122, '8xy3': 0x8123, '8xy4': 0x8124,
+    '8xy5': 0x8125, '8xy6': 0x8126, '8xy7': 0x8127, '8xyE': 0x812E,
+    '9xy0': 0x9120, 'Annn': 0xA300, 'Bnnn': 0xB300, 'Cxkk': 0xC1FF, 'Dxyn': 0xD125,
+    'Ex9E': 0xE19E, 'ExA1': 0xE1A1, 'Fx07': 0xF107, 'Fx15': 0xF115, 'Fx18': 0xF118,
+    'Fx1E': 0xF11E, 'Fx29': 0xF129, 'Fx33': 0xF133, 'Fx55': 0xF555, 'Fx65': 0xF565,
+}
+
+# (name, clipping, x, y) for 8x15 sprites
+draw_cases = [
+    ('draw clip inside', True, 20, 8),
+    ('draw clip edge', True, 60, 28),
+    ('draw wrap inside', False, 20, 8),
+    ('draw wrap edge', False, 60, 28),
+]
+
+
+def make_cpu(clipping=True, engine='interpreter', rom=None):
+    quirks = dict(default_quirks, clipping=clipping)
+    cpu = CPU(**quirks, screen=None, engine=engine, headless=True, seed=0,
+              input_backend=ScriptedInput(scripts.get(rom) or game_script()))
+    if rom is not None:
+        cpu.load_rom(rom)
+    cpu.pc_limit = 1 << 30  # micro benchmarks never fetch, keep them from halting
+    return cpu
+
+
+def reset_cpu(cpu):
+    cpu.PC = 0x200
+    cpu.I = 0x300
+    cpu.V[:] = bytes((i * 7) & 0xFF for i in range(16))
+    cpu.stack[:] = [0x200] * len(cpu.stack)
+
+
+def best_time(batch, count, repeat):
+    """Best time per call in nanoseconds, batch(count) returns the seconds `count` calls took."""
+    return min(batch(count) for _ in range(repeat)) / count * 1e9
+
+
+def opcode_batch(cpu, opcode):
+    # the stack holds 16 entries, so calls run from an empty one and returns from a full one, 16 at a time
+    sp = len(cpu.stack) if opcode == 0x00EE else 0
+    def batch(count):
+        reset_cpu(cpu)
+        execute = cpu.execute_opcode
+        start = time.perf_counter()
+        for first in range(0, count, 16):
+            cpu.SP = sp
+            for _ in range(min(16, count - first)):
+                execute(opcode)
+        return time.perf_counter() - start
+    return batch
+
+
+def draw_batch(cpu, x, y):
+    def batch(count):
+        reset_cpu(cpu)
+        draw = cpu.draw_sprite
+        start = time.perf_counter()
+        for _ in range(count):
+            draw(x, y, 15)
+        return time.perf_counter() - start
+    return batch
+
+
+def micro_benchmarks(count, repeat):
+    results = {}
+    cpu = make_cpu()
+    for name, opcode in opcode_families.items():
+        results[name] = best_time(opcode_batch(cpu, opcode), count, repeat)
+    for name, clipping, x, y in draw_cases:
+        results[name] = best_time(draw_batch(make_cpu(clipping=clipping), x, y), count, repeat)
+    return results
+
+
+def macro_run(rom, cycles, engine):
+    """Runs a fresh CPU for `cycles` instructions, returns the elapsed seconds and the CPU."""
+    cpu = make_cpu(engine=engine, rom=rom)
+    cpu.pc_limit = min(len(cpu.memory), cpu.start_address + cpu.rom_size + 1)
+    cpu.idle_skip = False
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        cpu.run(cycles)
+    return time.perf_counter() - start, cpu
+
+
+def macro_benchmarks(cycles, repeat, engine):
+    results = {}
+    for rom in macro_roms:
+        elapsed, cpu = min((macro_run(rom, cycles, engine) for _ in range(repeat)), key=lambda run: run[0])
+        results[rom] = {
+            'ips': cpu.cycles / elapsed,
+            'fps': cpu.frames / elapsed,
+            'cycles': cpu.cycles,
+            'seconds': elapsed,
+        }
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Prints every result next to its baseline and returns the names that regressed."""
+    regressions = []
+    for name, value in results['micro'].items():
+        old = baseline.get('micro', {}).get(name)
+        change = (value - old) / old if old else 0.0
+        flag = 'REGRESSION' if change > threshold else ''
+        if flag:
+            regressions.append(name)
+        print(f'{name:<20} {value:>10.0f} ns {change:>+8.1%} {flag}')
+    for rom, value in results['macro'].items():
+        old = baseline.get('macro', {}).get(rom, {}).get('ips')
+        change = (value['ips'] - old) / old if old else 0.0
+        flag = 'REGRESSION' if -change > threshold else ''
+        if flag:
+            regressions.append(rom)
+        print(f"{rom:<20} {value['ips']:>12,.0f} ips {value['fps']:>10,.0f} fps {change:>+8.1%} {flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark opcode families, sprite drawing and real ROMs.')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare against the results in this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.10, help='relative slowdown that counts as a regression')
+    parser.add_argument('--engine', default='interpreter', choices=['interpreter', 'block'],
+                        help='engine for the macro benchmarks, micro benchmarks always time the dispatch table handlers')
+    parser.add_argument('--count', type=int, default=20000, help='calls per micro benchmark run')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per micro benchmark, the best one counts')
+    parser.add_argument('--cycles', type=int, default=2000000, help='instructions per macro benchmark run')
+    parser.add_argument('--macro-repeat', type=int, default=3, help='runs per ROM, the fastest one counts')
+    args = parser.parse_args()
+
+    with contextlib.redirect_stdout(io.StringIO()):  # 0NNN and unknown opcodes print
+        micro = micro_benchmarks(args.count, args.repeat)
+    results = {
+        'meta': {
+            'python': platform.python_version(),
+            'engine': args.engine,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'micro': micro,
+        'macro': macro_benchmarks(args.cycles, args.macro_repeat, args.engine),
+    }
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    regressions = compare(results, baseline, args.threshold)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=4)
+            file.write('\n')
+
+    if regressions:
+        print(f'{len(regressions)} regressions over {args.threshold:.0%}: {", ".join(regressions)}')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
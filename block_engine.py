@@ -0,0 +1,223 @@
+# Straight-line runs of CHIP-8 code are translated into one Python function
+# per basic block. A block ends at the first jump, call, return, skip, draw,
+# key wait or memory store. Key waits, memory stores and rare opcodes run
+# through the CPU's dispatch handlers, everything else is inlined.
+
+max_block_length = 64
+
+_stores = (0xF033, 0xF055)
+
+def _store_length(opcode):
+    """Offset of the last byte written at I by a store opcode."""
+    if opcode & 0xF0FF == 0xF033:
+        return 2
+    return (opcode & 0x0F00) >> 8
+
+
+class BlockCache:
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.blocks = {}    # start address -> (function, instruction count)
+        self.covering = {}  # byte address -> start addresses of blocks using it
+
+    def clear(self):
+        self.blocks.clear()
+        self.covering.clear()
+
+    def invalidate(self, start, end):
+        """Drops every cached block that covers an address in start..end (inclusive)."""
+        for address in range(start, end + 1):
+            starts = self.covering.pop(address & 0xFFF, None)
+            if starts:
+                for block_start in starts:
+                    self.blocks.pop(block_start, None)
+
+    def execute_cycles(self, cycles):
+        """
+        Executes up to `cycles` instructions and returns how many ran.
+        A block that does not fit in the remaining budget is stepped through
+        the interpreter, so instruction counts match the interpreter exactly.
+        """
+        cpu = self.cpu
+        blocks = self.blocks
+        dispatch = cpu.dispatch
+        memory = cpu.memory
+        done = 0
+        while done < cycles and cpu.running:
+            pc = cpu.PC
+            block = blocks.get(pc)
+            if block is None:
+                block = self.compile(pc)
+            function, length = block
+            if length <= cycles - done:
+                function(cpu)
+                done += length
+            else:
+                opcode = (memory[pc] << 8) | memory[pc+1]
+                I = cpu.I
+                dispatch[opcode](cpu)
+                if opcode & 0xF0FF in _stores:
+                    self.invalidate(I, I + _store_length(opcode))
+                done += 1
+        return done
+
+    def compile(self, start):
+        cpu = self.cpu
+        memory = cpu.memory
+        namespace = {'randint': cpu.rng.randint, 'invalidate': self.invalidate}
+        lines = ['def block(cpu):', '    V = cpu.V']
+
+        address = start
+        length = 0
+        terminated = False
+        while not terminated and length < max_block_length:
+            opcode = (memory[address] << 8) | memory[address+1]
+            translated = _translate(cpu, opcode, address)
+            if translated is None:
+                # no inline form, run the dispatch handler with PC in place
+                handler = f'op_{length}'
+                namespace[handler] = cpu.dispatch[opcode]
+                lines.append(f'    cpu.PC = {address}')
+                if opcode & 0xF0FF in _stores:
+                    lines.append('    I = cpu.I')
+                    lines.append(f'    {handler}(cpu)')
+                    lines.append(f'    invalidate(I, I + {_store_length(opcode)})')
+                else:
+                    lines.append(f'    {handler}(cpu)')
+                terminated = True
+            else:
+                body, terminated = translated
+                lines.extend('    ' + line for line in body)
+            address += 2
+            length += 1
+            if address >= cpu.pc_limit:
+                break
+
+        if not terminated:
+            lines.append(f'    cpu.PC = {address}')
+            if address >= cpu.pc_limit:
+                lines.append('    cpu.running = False')
+
+        exec('\n'.join(lines), namespace)
+        block = (namespace['block'], length)
+        self.blocks[start] = block
+        for byte_address in range(start, address):
+            self.covering.setdefault(byte_address, set()).add(start)
+        return block
+
+
+def _advance(step_lines):
+    """Source that moves PC the way the interpreter's _next does."""
+    return step_lines + ['cpu.PC = pc', 'if pc >= cpu.pc_limit:', '    cpu.running = False']
+
+
+def _translate(cpu, opcode, address):
+    """
+    Returns (source lines, ends block) for an opcode, or None when it has to
+    run through its dispatch handler. Lines that end a block set PC themselves.
+    """
+    x = (opcode & 0x0F00) >> 8
+    y = (opcode & 0x00F0) >> 4
+    n = opcode & 0x000F
+    nn = opcode & 0x00FF
+    nnn = opcode & 0x0FFF
+    reset = ['V[15] = 0'] if cpu.vf_reset else []
+    skip = f'pc = {address + 4} if {{}} else {address + 2}'
+
+    # control flow, always the last instruction of a block
+    if opcode == 0x00EE:
+        return ['sp = cpu.SP - 1',
+                'if sp < 0:',
+                f'    cpu.PC = {address}',
+                "    cpu.stack_fault('underflow')",
+                'else:',
+                '    cpu.SP = sp',
+                '    cpu.PC = cpu.stack[sp]'], True
+    if opcode & 0xF000 == 0x1000:
+        return [f'cpu.PC = {nnn}'], True
+    if opcode & 0xF000 == 0x2000:
+        return ['sp = cpu.SP',
+                'if sp == 16:',
+                f'    cpu.PC = {address}',
+                "    cpu.stack_fault('overflow')",
+                'else:',
+                f'    cpu.stack[sp] = {address + 2}',
+                '    cpu.SP = sp + 1',
+                f'    cpu.PC = {nnn}'], True
+    if opcode & 0xF000 == 0x3000:
+        return _advance([skip.format(f'V[{x}] == {nn}')]), True
+    if opcode & 0xF000 == 0x4000:
+        return _advance([skip.format(f'V[{x}] != {nn}')]), True
+    if opcode & 0xF00F == 0x5000:
+        return _advance([skip.format(f'V[{x}] == V[{y}]')]), True
+    if opcode & 0xF00F == 0x9000:
+        return _advance([skip.format(f'V[{x}] != V[{y}]')]), True
+    if opcode & 0xF000 == 0xB000:
+        return [f'cpu.PC = ({nnn} + V[{x if cpu.jumping else 0}]) & 0xFFF'], True
+    if opcode & 0xF00F == 0xD000 and cpu.schip:
+        return None
+    if opcode & 0xF000 == 0xD000:
+        draw = 'draw_sprite_clipped' if cpu.clipping else 'draw_sprite_wrapped'
+        return _advance([f'cpu.{draw}(V[{x}], V[{y}], {n})', f'pc = {address + 2}']), True
+    if opcode & 0xF0FF == 0xE09E:
+        return _advance([skip.format(f'(cpu.keypad >> V[{x}]) & 1')]), True
+    if opcode & 0xF0FF == 0xE0A1:
+        return _advance([skip.format(f'not (cpu.keypad >> V[{x}]) & 1')]), True
+
+    # straight-line instructions
+    if opcode == 0x0000:
+        return [], False
+    if opcode == 0x00E0:
+        return ['cpu.videosystem.clear()'], False
+    if opcode & 0xF000 == 0x6000:
+        return [f'V[{x}] = {nn}'], False
+    if opcode & 0xF000 == 0x7000:
+        return [f'V[{x}] = (V[{x}] + {nn}) & 0xFF'], False
+    if opcode & 0xF00F == 0x8000:
+        return [f'V[{x}] = V[{y}]'], False
+    if opcode & 0xF00F == 0x8001:
+        return reset + [f'V[{x}] = V[{x}] | V[{y}]'], False
+    if opcode & 0xF00F == 0x8002:
+        return reset + [f'V[{x}] = V[{x}] & V[{y}]'], False
+    if opcode & 0xF00F == 0x8003:
+        return reset + [f'V[{x}] = V[{x}] ^ V[{y}]'], False
+    if opcode & 0xF00F == 0x8004:
+        return [f'total = V[{x}] + V[{y}]',
+                f'V[{x}] = total & 0xFF',
+                'V[15] = 1 if total > 0xFF else 0'], False
+    if opcode & 0xF00F == 0x8005:
+        return [f'flag = 1 if V[{x}] >= V[{y}] else 0',
+                f'V[{x}] = (V[{x}] - V[{y}]) & 0xFF',
+                'V[15] = flag'], False
+    if opcode & 0xF00F == 0x8006:
+        return [f'flag = V[{x}] & 0x1',
+                f'V[{x}] = V[{x if cpu.shifting else y}] >> 1',
+                'V[15] = flag'], False
+    if opcode & 0xF00F == 0x8007:
+        return [f'flag = 1 if V[{x}] <= V[{y}] else 0',
+                f'V[{x}] = (V[{y}] - V[{x}]) & 0xFF',
+                'V[15] = flag'], False
+    if opcode & 0xF00F == 0x800E:
+        return [f'flag = (V[{x}] & 0x80) >> 7',
+                f'V[{x}] = (V[{x if cpu.shifting else y}] << 1) & 0xFF',
+                'V[15] = flag'], False
+    if opcode & 0xF000 == 0xA000:
+        return [f'cpu.I = {nnn}'], False
+    if opcode & 0xF000 == 0xC000:
+        return [f'V[{x}] = randint(0, 255) & {nn}'], False
+    if opcode & 0xF0FF == 0xF007:
+        return [f'V[{x}] = cpu.DT'], False
+    if opcode & 0xF0FF == 0xF015:
+        return [f'cpu.DT = V[{x}]'], False
+    if opcode & 0xF0FF == 0xF018:
+        return [f'cpu.ST = V[{x}]'], False
+    if opcode & 0xF0FF == 0xF01E:
+        return [f'cpu.I = (cpu.I + V[{x}]) & 0xFFF'], False
+    if opcode & 0xF0FF == 0xF029:
+        return [f'cpu.I = 0x50 + V[{x}] * 5'], False
+    if opcode & 0xF0FF == 0xF065:
+        lines = ['I = cpu.I', f'V[:{x+1}] = cpu.read_memory(I, {x+1})']
+        if cpu.memory_i_inc:
+            lines.append(f'cpu.I = (I + {x+1}) & 0xFFF')
+        return lines, False
+    return None
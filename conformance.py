@@ -0,0 +1,125 @@
+import os
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import argparse
+import contextlib
+import glob
+import hashlib
+import io
+import json
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from backends import ScriptedInput
+from emulator import CPU, default_quirks
+
+# Runs every ROM headless for a fixed number of cycles with scripted input,
+# hashes the final framebuffer and memory and compares them to a golden file.
+#
+#   python conformance.py              check every ROM against the golden file
+#   python conformance.py --update     rewrite the golden file from this tree
+
+golden_path = 'conformance_golden.json'
+default_cycles = 50000
+
+
+def press(frame, key, hold=5):
+    return [(frame, key, True), (frame + hold, key, False)]
+
+# menu choices for the test ROMs, everything else gets the generic game script
+scripts = {
+    'tests/5-quirks.ch8': press(100, 0x1),   # its menu ignores keys for the first frames
+    'tests/6-keypad.ch8': press(10, 0x1) + press(40, 0x5, hold=30),
+    'tests/8-scrolling.ch8': press(60, 0x1) + press(120, 0x2),  # SUPER-CHIP, then high resolution
+}
+
+# ROMs that need more than the default quirks
+rom_quirks = {
+    'tests/8-scrolling.ch8': dict(schip=True),
+}
+
+def game_script():
+    """Taps the keys most games use for start, movement and fire."""
+    script = []
+    for i, key in enumerate([0x5, 0x4, 0x6, 0x2, 0x8, 0x1, 0xF, 0x5] * 8):
+        script += press(10 + i*30, key, hold=12)
+    return script
+
+
+def find_roms():
+    return sorted(glob.glob('tests/*.ch8')) + sorted(f for f in glob.glob('games/*') if os.path.isfile(f))
+
+
+def run_rom(rom, cycles, engine):
+    """Runs one ROM headless and returns its hashes and throughput."""
+    cpu = CPU(**default_quirks, **rom_quirks.get(rom, {}), screen=None, engine=engine, headless=True, seed=0,
+              input_backend=ScriptedInput(scripts.get(rom) or game_script()))
+    cpu.load_rom(rom)
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):  # unknown opcodes print
+        cpu.run(cycles)
+    elapsed = time.perf_counter() - start
+
+    return {
+        'rom': rom,
+        'framebuffer': hashlib.sha1(cpu.videosystem.to_bytes()).hexdigest(),
+        'memory': hashlib.sha1(bytes(cpu.memory)).hexdigest(),
+        'cycles': cpu.cycles,
+        # instructions fast-forwarded through idle loops did not run, they are counted separately
+        'idle_cycles': cpu.idle_cycles,
+        'ips': (cpu.cycles - cpu.idle_cycles) / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run ROMs headless and compare them to golden hashes.')
+    parser.add_argument('roms', nargs='*', help='ROMs to run, default is everything in tests/ and games/')
+    parser.add_argument('--cycles', type=int, default=default_cycles)
+    parser.add_argument('--jobs', type=int, default=os.cpu_count())
+    parser.add_argument('--engine', default='interpreter', choices=['interpreter', 'block'])
+    parser.add_argument('--golden', default=golden_path)
+    parser.add_argument('--update', action='store_true', help='write the results as the new golden file')
+    args = parser.parse_args()
+
+    roms = args.roms or find_roms()
+    golden = {}
+    if os.path.exists(args.golden):
+        with open(args.golden) as file:
+            golden = json.load(file)
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        results = list(pool.map(run_rom, roms, [args.cycles]*len(roms), [args.engine]*len(roms)))
+    elapsed = time.perf_counter() - start
+
+    failures = 0
+    for result in results:
+        expected = golden.get(result['rom'])
+        hashes = {'framebuffer': result['framebuffer'], 'memory': result['memory'], 'cycles': result['cycles']}
+        if args.update:
+            status = 'updated'
+            golden[result['rom']] = hashes
+        elif expected is None:
+            status = 'NEW'
+        elif expected == hashes:
+            status = 'ok'
+        else:
+            status = 'FAIL'
+            failures += 1
+        print(f"{result['rom']:<24} {status:<8} {result['cycles']:>8} cycles {result['idle_cycles']:>8} idle "
+              f"{result['ips']:>12,.0f} ips")
+
+    total_cycles = sum(result['cycles'] for result in results)
+    print(f'{len(results)} ROMs, {failures} failed, {total_cycles:,} cycles in {elapsed:.2f}s')
+
+    if args.update:
+        with open(args.golden, 'w') as file:
+            json.dump(golden, file, indent=4, sort_keys=True)
+            file.write('\n')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
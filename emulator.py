@@ -1,39 +1,546 @@
+import os
 import time
 import pygame
 import random
 
-emu_width, emu_height, emu_scale = 64, 32, 10
-
-class VideoSystem:
-    def __init__(self, width, height, scale, screen):
-        self.width, self.height = width, height
-        self.screen_width, self.screen_height = self.width*scale, self.height*scale
-        self.scale = scale
+from backends import NullVideo, VideoSystem, NullAudio, PygameAudio, NullInput, PygameInput
+from block_engine import BlockCache
+from savestate import RewindBuffer, read_state, state_path, write_state
+from telemetry import Telemetry
 
-        if screen == None:
-            self.screen = pygame.display.set_mode((self.screen_width, self.screen_height))
+emu_width, emu_height, emu_scale = 64, 32, 10
+hires_width, hires_height = 128, 64
+memory_size, stack_size = 4096, 16
+frame_rate = 60
+# Tab cycles through these, frames emulated per presented frame, None runs as many as fit in a frame's time
+turbo_speeds = [1, 2, 4, None]
+default_quirks = dict(vf_reset=False, memory_i_inc=False, clipping=True, shifting=True, jumping=True)
+
+# 4x5 hex digit sprites, loaded at 0x50
+fontset = [
+    0xF0, 0x90, 0x90, 0x90, 0xF0,
+    0x20, 0x60, 0x20, 0x20, 0x70,
+    0xF0, 0x10, 0xF0, 0x80, 0xF0,
+    0xF0, 0x10, 0xF0, 0x10, 0xF0,
+    0x90, 0x90, 0xF0, 0x10, 0x10,
+    0xF0, 0x80, 0xF0, 0x10, 0xF0,
+    0xF0, 0x80, 0xF0, 0x90, 0xF0,
+    0xF0, 0x10, 0x20, 0x40, 0x40,
+    0xF0, 0x90, 0xF0, 0x90, 0xF0,
+    0xF0, 0x90, 0xF0, 0x10, 0xF0,
+    0xF0, 0x90, 0xF0, 0x90, 0x90,
+    0xE0, 0x90, 0xE0, 0x90, 0xE0,
+    0xF0, 0x80, 0x80, 0x80, 0xF0,
+    0xE0, 0x90, 0x90, 0x90, 0xE0,
+    0xF0, 0x80, 0xF0, 0x80, 0xF0,
+    0xF0, 0x80, 0xF0, 0x80, 0x80 
+]
+
+# 8x10 hex digit sprites for SCHIP, loaded at 0xA0
+large_fontset = [
+    0xFF, 0xFF, 0xC3, 0xC3, 0xC3, 0xC3, 0xC3, 0xC3, 0xFF, 0xFF,
+    0x18, 0x78, 0x78, 0x18, 0x18, 0x18, 0x18, 0x18, 0xFF, 0xFF,
+    0xFF, 0xFF, 0x03, 0x03, 0xFF, 0xFF, 0xC0, 0xC0, 0xFF, 0xFF,
+    0xFF, 0xFF, 0x03, 0x03, 0xFF, 0xFF, 0x03, 0x03, 0xFF, 0xFF,
+    0xC3, 0xC3, 0xC3, 0xC3, 0xFF, 0xFF, 0x03, 0x03, 0x03, 0x03,
+    0xFF, 0xFF, 0xC0, 0xC0, 0xFF, 0xFF, 0x03, 0x03, 0xFF, 0xFF,
+    0xFF, 0xFF, 0xC0, 0xC0, 0xFF, 0xFF, 0xC3, 0xC3, 0xFF, 0xFF,
+    0xFF, 0xFF, 0x03, 0x03, 0x06, 0x0C, 0x18, 0x18, 0x18, 0x18,
+    0xFF, 0xFF, 0xC3, 0xC3, 0xFF, 0xFF, 0xC3, 0xC3, 0xFF, 0xFF,
+    0xFF, 0xFF, 0xC3, 0xC3, 0xFF, 0xFF, 0x03, 0x03, 0xFF, 0xFF,
+    0x7E, 0xFF, 0xC3, 0xC3, 0xC3, 0xFF, 0xFF, 0xC3, 0xC3, 0xC3,
+    0xFC, 0xFC, 0xC3, 0xC3, 0xFC, 0xFC, 0xC3, 0xC3, 0xFC, 0xFC,
+    0x3C, 0xFF, 0xC3, 0xC0, 0xC0, 0xC0, 0xC0, 0xC3, 0xFF, 0x3C,
+    0xFC, 0xFE, 0xC3, 0xC3, 0xC3, 0xC3, 0xC3, 0xC3, 0xFE, 0xFC,
+    0xFF, 0xFF, 0xC0, 0xC0, 0xFF, 0xFF, 0xC0, 0xC0, 0xFF, 0xFF,
+    0xFF, 0xFF, 0xC0, 0xC0, 0xFF, 0xFF, 0xC0, 0xC0, 0xC0, 0xC0
+]
+
+class FrameScheduler:
+    """
+    Paces frames against fixed deadlines rather than the time of the last
+    frame, so sleep overshoot and host jitter do not accumulate into drift.
+    A host that falls more than max_lag frames behind resynchronises instead
+    of rushing through the backlog.
+    """
+    def __init__(self, frame_rate, max_lag=5):
+        self.frame_time = 1 / frame_rate
+        self.max_lag = max_lag
+        self.next_frame = None
+        self.sleep_time = 0.0   # total seconds spent sleeping
+
+    def wait(self, idle=None):
+        """
+        Sleeps until the next frame is due. idle(timeout), when given, sleeps
+        instead and returns True if input cut the sleep short, the next frame
+        then starts right away and the frames after it are paced from there.
+        """
+        now = time.perf_counter()
+        if self.next_frame is None:
+            self.next_frame = now
+        self.next_frame += self.frame_time
+
+        delay = self.next_frame - now
+        if delay > 0:
+            if idle is None:
+                time.sleep(delay)
+            elif idle(delay):
+                self.next_frame = time.perf_counter()
+            self.sleep_time += time.perf_counter() - now
+        elif -delay > self.max_lag*self.frame_time:
+            self.next_frame = now
+
+
+# OPCODE DISPATCH
+# Every 16-bit opcode is decoded once into a handler that takes the CPU.
+# Operands and quirk choices are baked into the handler, a quirk picks one of
+# two handlers or a constant when the table is built rather than being tested
+# when the instruction runs, so executing an instruction is a single table
+# lookup and a single call.
+
+_dispatch_tables = {}
+
+def get_dispatch_table(vf_reset, memory_i_inc, clipping, shifting, jumping, schip=False):
+    quirks = (vf_reset, memory_i_inc, clipping, shifting, jumping, schip)
+    table = _dispatch_tables.get(quirks)
+    if table is None:
+        table = [_decode_opcode(opcode, *quirks) for opcode in range(0x10000)]
+        _dispatch_tables[quirks] = table
+    return table
+
+def clear_dispatch_tables():
+    """Drops the cached tables, about 20 MB each, CPUs that hold one keep it."""
+    _dispatch_tables.clear()
+
+def _next(cpu, step):
+    pc = cpu.PC + step
+    cpu.PC = pc
+    if pc >= cpu.pc_limit:
+        cpu.running = False
+
+def _ignored_opcode(opcode):
+    def op(cpu):
+        print(f'Ignored ONNN opcode at {hex(opcode)}')
+        _next(cpu, 2)
+    return op
+
+def _unknown_opcode(opcode):
+    def op(cpu):
+        print(f'UNKNOWN OPCODE --- {hex(opcode)} --- UNKOWN OPCODE')
+        _next(cpu, 2)
+    return op
+
+def _decode_opcode(opcode, vf_reset, memory_i_inc, clipping, shifting, jumping, schip=False):
+    x = (opcode & 0x0F00) >> 8
+    y = (opcode & 0x00F0) >> 4
+    n = opcode & 0x000F
+    nn = opcode & 0x00FF
+    nnn = opcode & 0x0FFF
+
+    # STARTING WITH 0
+    if opcode == 0x0000:
+        def op(cpu):
+            _next(cpu, 2)
+    elif opcode == 0x00E0:
+        # clear screen
+        def op(cpu):
+            cpu.videosystem.clear()
+            _next(cpu, 2)
+    elif opcode == 0x00EE:
+        # returns from a subroutine
+        def op(cpu):
+            sp = cpu.SP - 1
+            if sp < 0:
+                cpu.stack_fault('underflow')
+            else:
+                cpu.SP = sp
+                cpu.PC = cpu.stack[sp]
+    elif schip and opcode & 0xFFF0 == 0x00C0:
+        # SCHIP: scrolls the screen down N pixels
+        def op(cpu):
+            cpu.videosystem.scroll_down(n)
+            _next(cpu, 2)
+    elif schip and opcode == 0x00FB:
+        # SCHIP: scrolls the screen right 4 pixels
+        def op(cpu):
+            cpu.videosystem.scroll_right(4)
+            _next(cpu, 2)
+    elif schip and opcode == 0x00FC:
+        # SCHIP: scrolls the screen left 4 pixels
+        def op(cpu):
+            cpu.videosystem.scroll_left(4)
+            _next(cpu, 2)
+    elif schip and opcode == 0x00FD:
+        # SCHIP: exits the interpreter
+        def op(cpu):
+            cpu.running = False
+    elif schip and opcode == 0x00FE:
+        # SCHIP: switches to 64x32 and clears the screen
+        def op(cpu):
+            cpu.videosystem.resize(emu_width, emu_height)
+            _next(cpu, 2)
+    elif schip and opcode == 0x00FF:
+        # SCHIP: switches to 128x64 and clears the screen
+        def op(cpu):
+            cpu.videosystem.resize(hires_width, hires_height)
+            _next(cpu, 2)
+    elif opcode & 0xF000 == 0x0000:
+        # calls machine code routine (RCA 1802 for COSMAC VIP) at NNN, not necessary for most ROMs
+        op = _ignored_opcode(opcode)
+
+    # STARTING WITH 1
+    elif opcode & 0xF000 == 0x1000:
+        # jumps to address NNN
+        def op(cpu):
+            cpu.PC = nnn
+
+    # STARTING WITH 2
+    elif opcode & 0xF000 == 0x2000:
+        # calls subroutine at NNN
+        def op(cpu):
+            sp = cpu.SP
+            if sp == stack_size:
+                cpu.stack_fault('overflow')
+            else:
+                cpu.stack[sp] = cpu.PC+2
+                cpu.SP = sp + 1
+                cpu.PC = nnn
+
+    # STARTING WITH 3
+    elif opcode & 0xF000 == 0x3000:
+        # skips the next instruction if VX equals NN
+        def op(cpu):
+            _next(cpu, 4 if cpu.V[x] == nn else 2)
+
+    # STARTING WITH 4
+    elif opcode & 0xF000 == 0x4000:
+        # skips the next instruction if VX does not equal NN
+        def op(cpu):
+            _next(cpu, 4 if cpu.V[x] != nn else 2)
+
+    # STARTING WITH 5
+    elif opcode & 0xF00F == 0x5000:
+        # skips the next instruction if VX equals VY
+        def op(cpu):
+            V = cpu.V
+            _next(cpu, 4 if V[x] == V[y] else 2)
+
+    # STARTING WITH 6
+    elif opcode & 0xF000 == 0x6000:
+        # sets VX to NN
+        def op(cpu):
+            cpu.V[x] = nn
+            _next(cpu, 2)
+
+    # STARTING WITH 7
+    elif opcode & 0xF000 == 0x7000:
+        # adds NN to VX (carry flag is not changed)
+        def op(cpu):
+            V = cpu.V
+            V[x] = (V[x] + nn) & 0xFF
+            _next(cpu, 2)
+
+    # STARTING WITH 8
+    elif opcode & 0xF00F == 0x8000:
+        # sets VX to the value of VY
+        def op(cpu):
+            V = cpu.V
+            V[x] = V[y]
+            _next(cpu, 2)
+    elif opcode & 0xF00F == 0x8001:
+        # sets VX to VX or VY, the vf_reset quirk clears VF first
+        if vf_reset:
+            def op(cpu):
+                V = cpu.V
+                V[0xF] = 0
+                V[x] = V[x] | V[y]
+                _next(cpu, 2)
         else:
-            self.screen = screen
-
-        self.pixels = [[0 for _ in range(width)] for _ in range(height)]
-
-    def clear(self, color):
-        self.screen.fill(color)
-        self.pixels = [[0 for _ in range(self.width)] for _ in range(self.height)]
-        pygame.display.flip()
+            def op(cpu):
+                V = cpu.V
+                V[x] = V[x] | V[y]
+                _next(cpu, 2)
+    elif opcode & 0xF00F == 0x8002:
+        # sets VX to VX and VY, the vf_reset quirk clears VF first
+        if vf_reset:
+            def op(cpu):
+                V = cpu.V
+                V[0xF] = 0
+                V[x] = V[x] & V[y]
+                _next(cpu, 2)
+        else:
+            def op(cpu):
+                V = cpu.V
+                V[x] = V[x] & V[y]
+                _next(cpu, 2)
+    elif opcode & 0xF00F == 0x8003:
+        # sets VX to VX xor VY, the vf_reset quirk clears VF first
+        if vf_reset:
+            def op(cpu):
+                V = cpu.V
+                V[0xF] = 0
+                V[x] = V[x] ^ V[y]
+                _next(cpu, 2)
+        else:
+            def op(cpu):
+                V = cpu.V
+                V[x] = V[x] ^ V[y]
+                _next(cpu, 2)
+    elif opcode & 0xF00F == 0x8004:
+        # adds VY to VX, VF is set to 1 when there is a carry
+        def op(cpu):
+            V = cpu.V
+            total = V[x] + V[y]
+            V[x] = total & 0xFF
+            V[0xF] = 1 if total > 0xFF else 0
+            _next(cpu, 2)
+    elif opcode & 0xF00F == 0x8005:
+        # VY is subtracted from VX, VF is set to 0 when there is a borrow
+        def op(cpu):
+            V = cpu.V
+            no_borrow = V[x] >= V[y]
+            V[x] = (V[x] - V[y]) & 0xFF
+            V[0xF] = 1 if no_borrow else 0
+            _next(cpu, 2)
+    elif opcode & 0xF00F == 0x8006:
+        # stores the least significant bit of VX in VF and shifts VX to the right by 1,
+        # the shifting quirk shifts VX itself rather than VY
+        source = x if shifting else y
+        def op(cpu):
+            V = cpu.V
+            flag = V[x] & 0x1
+            V[x] = V[source] >> 1
+            V[0xF] = flag
+            _next(cpu, 2)
+    elif opcode & 0xF00F == 0x8007:
+        # sets VX to VY minus VX, VF is set to 0 when there is a borrow
+        def op(cpu):
+            V = cpu.V
+            no_borrow = V[x] <= V[y]
+            V[x] = (V[y] - V[x]) & 0xFF
+            V[0xF] = 1 if no_borrow else 0
+            _next(cpu, 2)
+    elif opcode & 0xF00F == 0x800E:
+        # stores the most significant bit of VX in VF and shifts VX to the left by 1,
+        # the shifting quirk shifts VX itself rather than VY
+        source = x if shifting else y
+        def op(cpu):
+            V = cpu.V
+            flag = (V[x] & 0x80) >> 7
+            V[x] = (V[source] << 1) & 0xFF
+            V[0xF] = flag
+            _next(cpu, 2)
+
+    # STARTING WITH 9
+    elif opcode & 0xF00F == 0x9000:
+        # skips the next instruction if VX does not equal VY
+        def op(cpu):
+            V = cpu.V
+            _next(cpu, 4 if V[x] != V[y] else 2)
+
+    # STARTING WITH A
+    elif opcode & 0xF000 == 0xA000:
+        # sets I to the address NNN
+        def op(cpu):
+            cpu.I = nnn
+            _next(cpu, 2)
+
+    # STARTING WITH B
+    elif opcode & 0xF000 == 0xB000:
+        # jumps to the address NNN plus V0 (or plus VX with the jumping quirk)
+        offset_register = x if jumping else 0
+        def op(cpu):
+            cpu.PC = (nnn + cpu.V[offset_register]) & 0xFFF
+
+    # STARTING WITH C
+    elif opcode & 0xF000 == 0xC000:
+        # sets VX to a random number and NN
+        def op(cpu):
+            cpu.V[x] = cpu.rng.randint(0, 255) & nn
+            _next(cpu, 2)
+
+    # STARTING WITH D
+    elif schip and opcode & 0xF00F == 0xD000:
+        # SCHIP: draws a 16x16 sprite from memory at I to (VX, VY), VF is set on collision
+        draw = CPU.draw_sprite_clipped if clipping else CPU.draw_sprite_wrapped
+        def op(cpu):
+            V = cpu.V
+            draw(cpu, V[x], V[y], 16, 16)
+            _next(cpu, 2)
+    elif opcode & 0xF000 == 0xD000:
+        # draws an 8xN sprite from memory at I to (VX, VY), VF is set on collision
+        draw = CPU.draw_sprite_clipped if clipping else CPU.draw_sprite_wrapped
+        def op(cpu):
+            V = cpu.V
+            draw(cpu, V[x], V[y], n)
+            _next(cpu, 2)
+
+    # STARTING WITH E
+    elif opcode & 0xF0FF == 0xE09E:
+        # skips the next instruction if the key stored in VX is pressed
+        def op(cpu):
+            _next(cpu, 4 if (cpu.keypad >> cpu.V[x]) & 1 else 2)
+    elif opcode & 0xF0FF == 0xE0A1:
+        # skips the next instruction if the key stored in VX is not pressed
+        def op(cpu):
+            _next(cpu, 2 if (cpu.keypad >> cpu.V[x]) & 1 else 4)
+
+    # STARTING WITH F
+    elif opcode & 0xF0FF == 0xF007:
+        # sets VX to the value of the delay timer
+        def op(cpu):
+            cpu.V[x] = cpu.DT
+            _next(cpu, 2)
+    elif opcode & 0xF0FF == 0xF00A:
+        # a key press is awaited and then stored in VX, PC stays here until it arrives
+        def op(cpu):
+            if cpu.wait_for_key(x):
+                _next(cpu, 2)
+    elif opcode & 0xF0FF == 0xF015:
+        # sets the delay timer to VX
+        def op(cpu):
+            cpu.DT = cpu.V[x]
+            _next(cpu, 2)
+    elif opcode & 0xF0FF == 0xF018:
+        # sets the sound timer to VX
+        def op(cpu):
+            cpu.ST = cpu.V[x]
+            _next(cpu, 2)
+    elif opcode & 0xF0FF == 0xF01E:
+        # adds VX to I, VF is not affected
+        def op(cpu):
+            cpu.I = (cpu.I + cpu.V[x]) & 0xFFF
+            _next(cpu, 2)
+    elif opcode & 0xF0FF == 0xF029:
+        # sets I to the location of the font sprite for the character in VX
+        def op(cpu):
+            cpu.I = 0x50 + (cpu.V[x] * 5)
+            _next(cpu, 2)
+    elif schip and opcode & 0xF0FF == 0xF030:
+        # SCHIP: sets I to the location of the large font sprite for the character in VX
+        def op(cpu):
+            cpu.I = 0xA0 + (cpu.V[x] * 10)
+            _next(cpu, 2)
+    elif opcode & 0xF0FF == 0xF033:
+        # stores the binary-coded decimal representation of VX at I, I+1 and I+2
+        def op(cpu):
+            value = cpu.V[x]
+            memory = cpu.memory
+            I = cpu.I
+            memory[I]                 = value // 100
+            memory[(I + 1) & 0xFFF]   = (value // 10) % 10
+            memory[(I + 2) & 0xFFF]   = value % 10
+            _next(cpu, 2)
+    elif opcode & 0xF0FF == 0xF055:
+        # stores V0 to VX (including VX) in memory starting at address I,
+        # the memory_i_inc quirk leaves I past the last address
+        increment = x+1 if memory_i_inc else 0
+        def op(cpu):
+            memory = cpu.memory
+            V = cpu.V
+            I = cpu.I
+            if I + x+1 <= memory_size:
+                memory[I:I+x+1] = V[:x+1]
+            else:
+                for i in range(x+1):
+                    memory[(I+i) & 0xFFF] = V[i]
+            cpu.I = (I + increment) & 0xFFF
+            _next(cpu, 2)
+    elif opcode & 0xF0FF == 0xF065:
+        # fills V0 to VX (including VX) with values from memory starting at address I,
+        # the memory_i_inc quirk leaves I past the last address
+        increment = x+1 if memory_i_inc else 0
+        def op(cpu):
+            I = cpu.I
+            cpu.V[:x+1] = cpu.read_memory(I, x+1)
+            cpu.I = (I + increment) & 0xFFF
+            _next(cpu, 2)
+    elif schip and opcode & 0xF0FF == 0xF075:
+        # SCHIP: stores V0 to VX (including VX) in the RPL user flags
+        def op(cpu):
+            cpu.rpl[:x+1] = cpu.V[:x+1]
+            _next(cpu, 2)
+    elif schip and opcode & 0xF0FF == 0xF085:
+        # SCHIP: fills V0 to VX (including VX) from the RPL user flags
+        def op(cpu):
+            cpu.V[:x+1] = cpu.rpl[:x+1]
+            _next(cpu, 2)
+    elif opcode == 0xF002:
+        # XO-CHIP: loads the 16 byte audio pattern at I, played instead of the beep
+        def op(cpu):
+            cpu.audio_pattern = bytes(cpu.read_memory(cpu.I, 16))
+            cpu.audio_backend.set_pattern(cpu.audio_pattern, cpu.pitch)
+            _next(cpu, 2)
+    elif opcode & 0xF0FF == 0xF03A:
+        # XO-CHIP: sets the audio pattern pitch to VX
+        def op(cpu):
+            cpu.pitch = cpu.V[x]
+            if cpu.audio_pattern is not None:
+                cpu.audio_backend.set_pattern(cpu.audio_pattern, cpu.pitch)
+            _next(cpu, 2)
+
+    # OPCODE NOT FOUND
+    else:
+        op = _unknown_opcode(opcode)
+
+    return op
 
 class CPU:
-    def __init__(self, vf_reset, memory_i_inc, clipping, shifting, jumping, screen):
-        self.run = True
-        self.memory = [0] * 4096
+    # a fixed set of attributes keeps instances small when many CPUs share a process
+    __slots__ = (
+        'running', 'memory', 'start_address', 'rom_size', 'rom_path', 'pc_limit',
+        'V', 'I', 'PC', 'SP', 'DT', 'ST', 'stack', 'rpl', 'keypad',
+        'key_wait', 'key_wait_held', 'key_wait_value', 'idle_loop', 'idle_skip', 'idle_cycles',
+        'instructions_per_frame', 'frame_cycles', 'frames', 'cycles', 'scheduler',
+        'rewind_buffer', 'rewinding', 'turbo', 'telemetry', 'rng', 'theme', 'base_color', 'draw_color',
+        'vf_reset', 'memory_i_inc', 'clipping', 'shifting', 'jumping', 'schip',
+        'fontset', 'dispatch', 'block_cache', 'engine',
+        'videosystem', 'audio_backend', 'input_backend', 'audio_pattern', 'pitch', 'sprite_width',
+    )
+
+    def __init__(self, vf_reset, memory_i_inc, clipping, shifting, jumping, screen, engine='interpreter',
+                 headless=False, video_backend=None, audio_backend=None, input_backend=None, ips=480,
+                 rewind_seconds=None, seed=None, schip=False):
+        self.running = True
+        self.memory = bytearray(memory_size)
         self.start_address = 0x200
         self.rom_size = None
+        self.rom_path = None
+
+        # instructions run in batches of one 60 Hz frame, the timers decrement once per frame
+        self.instructions_per_frame = max(1, round(ips / frame_rate))
+        self.frame_cycles = 0   # instructions already run in the current frame
+        self.frames = 0
+        self.scheduler = FrameScheduler(frame_rate)
+
+        # holding backspace steps back through the last rewind_seconds of play
+        self.rewind_buffer = RewindBuffer(rewind_seconds, frame_rate) if rewind_seconds else None
+        self.rewinding = False
+
+        # fast-forward, see turbo_speeds
+        self.turbo = 1
+
+        # live performance numbers, F3 attaches a Telemetry and draws it over the game
+        self.telemetry = None
+
+        # held keys as a bitmask, bit k for key k, sampled from the input backend once per frame
+        self.keypad = 0
 
-        self.decrement_timers_timer = 1
-        self.decrement_timers = 8
+        # Fx0A in progress: the register to fill, the keys seen at the last check and the key pressed so far
+        self.key_wait = None
+        self.key_wait_held = 0
+        self.key_wait_value = None
 
-        self.playing_sound = False
-        self.sound = pygame.mixer.Sound('beep.mp3')
+        # 'jump' or 'timer' while frames are fast-forwarded through an idle loop
+        # tools that need every instruction to really run (the profiler) turn idle_skip off
+        self.idle_loop = None
+        self.idle_skip = True
+        self.idle_cycles = 0
+
+        self.cycles = 0
+
+        # Cxkk draws from a per-CPU generator so a seeded run is reproducible
+        self.rng = random.Random(seed)
 
 
         self.theme = 'retro blue'
@@ -77,78 +584,85 @@ class CPU:
         self.shifting = shifting
         self.jumping = jumping
 
-        self.fontset = [
-            0xF0, 0x90, 0x90, 0x90, 0xF0,
-            0x20, 0x60, 0x20, 0x20, 0x70,
-            0xF0, 0x10, 0xF0, 0x80, 0xF0,
-            0xF0, 0x10, 0xF0, 0x10, 0xF0,
-            0x90, 0x90, 0xF0, 0x10, 0x10,
-            0xF0, 0x80, 0xF0, 0x10, 0xF0,
-            0xF0, 0x80, 0xF0, 0x90, 0xF0,
-            0xF0, 0x10, 0x20, 0x40, 0x40,
-            0xF0, 0x90, 0xF0, 0x90, 0xF0,
-            0xF0, 0x90, 0xF0, 0x10, 0xF0,
-            0xF0, 0x90, 0xF0, 0x90, 0x90,
-            0xE0, 0x90, 0xE0, 0x90, 0xE0,
-            0xF0, 0x80, 0x80, 0x80, 0xF0,
-            0xE0, 0x90, 0x90, 0x90, 0xE0,
-            0xF0, 0x80, 0xF0, 0x80, 0xF0,
-            0xF0, 0x80, 0xF0, 0x80, 0x80 
-        ]
-
-        self.key_map = {
-            pygame.K_x: 0x0,  # 0
-            pygame.K_1: 0x1,  # 1
-            pygame.K_2: 0x2,  # 2
-            pygame.K_3: 0x3,  # 3
-            pygame.K_q: 0x4,  # 4
-            pygame.K_w: 0x5,  # 5
-            pygame.K_e: 0x6,  # 6
-            pygame.K_a: 0x7,  # 7
-            pygame.K_s: 0x8,  # 8
-            pygame.K_d: 0x9,  # 9
-            pygame.K_z: 0xA,  # A
-            pygame.K_c: 0xB,  # B
-            pygame.K_4: 0xC,  # C
-            pygame.K_r: 0xD,  # D
-            pygame.K_f: 0xE,  # E
-            pygame.K_v: 0xF   # F
-        }
+        # SUPER-CHIP: 128x64 mode, scrolling, 16x16 sprites, the large font and the RPL flags
+        self.schip = schip
+        self.rpl = [0]*16
 
-        for i, byte in enumerate(self.fontset):
-            self.memory[0x50 + i] = byte
+        self.fontset = fontset
 
+        self.memory[0x50:0x50+len(self.fontset)] = bytes(self.fontset)
+        if schip:
+            self.memory[0xA0:0xA0+len(large_fontset)] = bytes(large_fontset)
 
-        self.stack = []
+        # return addresses, SP is the number in use
+        self.stack = [0]*stack_size
 
-        self.skip_next_instruction = False
+        self.dispatch = get_dispatch_table(vf_reset, memory_i_inc, clipping, shifting, jumping, schip)
+        self.pc_limit = len(self.memory)
 
-        self.videosystem = VideoSystem(emu_width, emu_height, emu_scale, screen)
-        self.videosystem.clear(self.base_color)
+        # 'interpreter' steps one opcode at a time, 'block' runs cached translated blocks
+        if engine == 'interpreter':
+            self.block_cache = None
+        elif engine == 'block':
+            self.block_cache = BlockCache(self)
+        else:
+            raise ValueError(f'unknown engine {engine!r}')
+        self.engine = engine
 
-        self.V = [0]*16
+        # headless CPUs default to null backends that never touch a display, audio device or keyboard
+        if video_backend is None:
+            if headless:
+                video_backend = NullVideo(emu_width, emu_height)
+            else:
+                video_backend = VideoSystem(emu_width, emu_height, emu_scale, screen, self.base_color, self.draw_color)
+        if audio_backend is None:
+            audio_backend = NullAudio() if headless else PygameAudio()
+        if input_backend is None:
+            input_backend = NullInput() if headless else PygameInput()
+
+        self.videosystem = video_backend
+        self.audio_backend = audio_backend
+        self.input_backend = input_backend
+        self.videosystem.clear()
+
+        self.V = bytearray(16)
         self.I = self.start_address     # INDEX POINTER
         self.PC = self.start_address    # PROGRAM COUNTER
         self.SP = 0                     # STACK POINTER
         self.DT = 0                     # DELAY TIMER
         self.ST = 0                     # SOUND TIMER
 
+        # XO-CHIP audio, the beep is replaced once a ROM loads a pattern with F002
+        self.audio_pattern = None
+        self.pitch = 64
+
         self.sprite_width = 8
 
     def load_rom(self, path):
+        self.rom_path = path
         with open(path, 'rb') as file:
             file_rom = file.read()
-            for i, byte in enumerate(file_rom):
-                self.memory[self.start_address + i] = byte
-            self.rom_size = len(file_rom)
+        if len(file_rom) > len(self.memory) - self.start_address:
+            raise ValueError(f'{path} is {len(file_rom)} bytes, only {len(self.memory) - self.start_address} fit in memory')
+        self.memory[self.start_address:self.start_address+len(file_rom)] = file_rom
+        self.rom_size = len(file_rom)
+        self.pc_limit = min(len(self.memory), self.start_address + self.rom_size + 1)
+        if self.block_cache is not None:
+            self.block_cache.clear()
 
     def get_pressed_chip8_keys(self):
-        keys = pygame.key.get_pressed()
-        pressed = []
-        for key, chip8_val in self.key_map.items():
-            if keys[key]:
-                pressed.append(chip8_val)
-        return pressed
+        return [key for key in range(16) if (self.keypad >> key) & 1]
+
+    def read_memory(self, address, count):
+        """`count` bytes from address on, wrapping past the end of memory like the 12-bit address bus."""
+        if address + count <= memory_size:
+            return self.memory[address:address+count]
+        return bytes(self.memory[(address+i) & 0xFFF] for i in range(count))
+
+    def stack_fault(self, kind):
+        """A call with all 16 stack entries in use or a return with none, halts the CPU."""
+        print(f'STACK {kind.upper()} --- at {hex(self.PC)} --- STACK {kind.upper()}')
+        self.running = False
 
     def get_opcode(self):
         return (self.memory[self.PC] << 8) + self.memory[self.PC+1]
@@ -168,411 +682,311 @@ class CPU:
     def get_nnn(self, opcode):
         return opcode&0x0FFF
     
-    def maskV(self, index):
-        self.V[index] = self._mask8(self.V[index])
-    
-    def draw_sprite(self, x, y, height):
-
+    def draw_sprite(self, x, y, height, sprite_width=8):
         """
         Draws a sprite at (x, y) with given height.
-        Each row of the sprite is a byte in memory starting at self.I.
+        Each row of the sprite is a byte in memory starting at self.I, or two
+        bytes for the 16 pixel wide SCHIP sprites.
         XORs pixels to the screen and sets VF if any pixels are erased.
+        Framebuffer rows are integers with the leftmost pixel in the highest
+        bit, so every sprite row is one shift, one AND and one XOR.
+        Dxyn handlers call the clipping or wrapping variant directly.
         """
-        self.V[0xF] = 0  # Reset collision flag
-
-        sprite_in_world_x = self.videosystem.scale*x
-        sprite_in_world_y = self.videosystem.scale*y
-
-        while sprite_in_world_x >= self.videosystem.screen_width:
-            sprite_in_world_x -= self.videosystem.screen_width
-        while sprite_in_world_y >= self.videosystem.screen_height:
-            sprite_in_world_y -= self.videosystem.screen_height
-
-        new_x = x
-        new_y = y
-
-        while new_x >= self.videosystem.width:
-            new_x -= self.videosystem.width
-        while new_y >= self.videosystem.height:
-            new_y -= self.videosystem.height
-
-        for row in range(height):
-            pixel_row = format(self.memory[self.I+row], '08b')
-            for sprite_x_index, pixel_value in enumerate(pixel_row):
-
-                pixel_in_world_x = sprite_in_world_x+sprite_x_index*self.videosystem.scale
-                pixel_in_world_y = sprite_in_world_y+row*self.videosystem.scale
-
-                x_wrap_count = 0
-                y_wrap_count = 0
-
-                if not self.clipping:
-                    while pixel_in_world_x >= self.videosystem.screen_width:
-                        pixel_in_world_x -= self.videosystem.screen_width
-                        x_wrap_count += 1
-                    while pixel_in_world_y >= self.videosystem.screen_height:
-                        pixel_in_world_y -= self.videosystem.screen_height
-                        y_wrap_count += 1
-                else:
-                    if pixel_in_world_x >= self.videosystem.screen_width or pixel_in_world_y >= self.videosystem.screen_height:
-                        continue
-
-                if int(pixel_value) == 1:
-                    if self.videosystem.pixels[(new_y+row)-y_wrap_count*self.videosystem.height][(new_x+sprite_x_index)-x_wrap_count*self.videosystem.width] == 0:
-                        self.videosystem.pixels[(new_y+row)-y_wrap_count*self.videosystem.height][(new_x+sprite_x_index)-x_wrap_count*self.videosystem.width] = 1
-                        pygame.draw.rect(self.videosystem.screen, self.draw_color, (pixel_in_world_x, pixel_in_world_y, self.videosystem.scale, self.videosystem.scale))
-
-                    else:
-                        self.videosystem.pixels[(new_y+row)-y_wrap_count*self.videosystem.height][(new_x+sprite_x_index)-x_wrap_count*self.videosystem.width] = 0
-                        pygame.draw.rect(self.videosystem.screen, self.base_color, (pixel_in_world_x, pixel_in_world_y, self.videosystem.scale, self.videosystem.scale))
-
-                        self.V[0xF] = 1
-        
-        pygame.display.update()
-  
-    def execute_opcode(self, opcode):
-        # STARTING WITH 0
-        if opcode == 0x0000:
-            self.increment_pc()
-        elif opcode == 0x00E0:
-            # print('clear screen') 
-            self.videosystem.clear(self.base_color)
-            self.increment_pc()
-        elif opcode == 0x00EE:
-            # print('returns form a subroutine')
-            self.PC = self.stack.pop()
-        elif opcode & 0xF000 == 0x0000:
-            # print('Calls machine code routine (RCA 1802 for COSMAC VIP) at address NNN. Not necessary for most ROMs.')
-            print(f'Ignored ONNN opcode at {hex(opcode)}')
-            self.increment_pc()
-
-        # STARTING WITH 1
-        elif opcode & 0xF000 == 0x1000:
-            # print(f'jumps to addresss {hex(opcode&0x0FFF)}')
-            self.PC = self.get_nnn(opcode)
-
-        # STARTING WITH 2
-        elif opcode & 0xF000 == 0x2000:
-            # print(f'calls subroutine at {hex(opcode&0x0FFF)}')
-            self.stack.append(self.PC+2)
-            self.PC = self.get_nnn(opcode)
-
-        # STARTING WITH 3
-        elif opcode & 0xF000 == 0x3000:
-            # print('skips the next instruction if VX equals NN. (usually the next instruction is  a jump to skip a code block)')
-            if self.V[self.get_x(opcode)] == self.get_nn(opcode):
-                self.skip_next_instruction = True
-            self.increment_pc()
-
-        # STARTING WITH 4
-        elif opcode & 0xF000 == 0x4000:
-            # print('Skips the next instruction if VX does not equal NN. (Usually the next instruction is a jump to skip a code block);')
-            if self.V[self.get_x(opcode)] != self.get_nn(opcode):
-                self.skip_next_instruction = True
-            self.increment_pc()
-
-        # STARTING WITH 5
-        elif opcode & 0xF00F == 0x5000:
-            # print('Skips the next instruction if VX equals VY. (Usually the next instruction is a jump to skip a code block);')
-            if self.V[self.get_x(opcode)] == self.V[self.get_y(opcode)]:
-                self.skip_next_instruction = True
-            self.increment_pc()
-
-        # STARTING WITH 6
-        elif opcode & 0xF000 == 0x6000:
-            # print('Sets VX to NN.')
-            self.V[self.get_x(opcode)] = self.get_nn(opcode)
-            self.increment_pc()
-
-        # STARTING WITH 7
-        elif opcode & 0xF000 == 0x7000:
-            # print('Adds NN to VX. (Carry flag is not changed);')
-            self.V[self.get_x(opcode)] += self.get_nn(opcode)
-            self.maskV(self.get_x(opcode))
-            self.increment_pc()
-        
-        # STARTING WITH 8
-        elif opcode & 0xF00F == 0x8000:
-            #print('Sets VX to the value of VY.')
-            self.V[self.get_x(opcode)] = self.V[self.get_y(opcode)]
-            self.increment_pc()
-        elif opcode & 0xF00F == 0x8001:
-            #print('Sets VX to VX or VY. (Bitwise OR operation);')
-            if self.vf_reset:
-                self.V[0xF] = 0
-
-            x = self.get_x(opcode)
-            y = self.get_y(opcode)
-
-            self.V[x] = self.V[x] | self.V[y]
-
-            self.increment_pc()
-        elif opcode & 0xF00F == 0x8002:
-            #print('Sets VX to VX and VY. (Bitwise AND operation);')
-            if self.vf_reset:
-                self.V[0xF] = 0
-
-            x = self.get_x(opcode)
-            y = self.get_y(opcode)
-
-            self.V[x] = self.V[x] & self.V[y]
-            
-            self.increment_pc()
-        elif opcode & 0xF00F == 0x8003:
-            #print('Sets VX to VX xor VY.')
-            if self.vf_reset:
-                self.V[0xF] = 0
-
-            x = self.get_x(opcode)
-            y = self.get_y(opcode)
-
-            self.V[x] = self.V[x] ^ self.V[y]
-            self.increment_pc()
-        elif opcode & 0xF00F == 0x8004:
-            #print('Adds VY to VX. VF is set to 1 when theres a carry, and to 0 when there is not.')
-            x = self.get_x(opcode)
-            y = self.get_y(opcode)
-
-            total = self.V[x] + self.V[y]
-            self.V[x] = total & 0xFF
-            self.V[0xF] = 1 if total > 0xFF else 0  # Set VF if carry
-
-            self.increment_pc()
-        elif opcode & 0xF00F == 0x8005:
-            #print('VY is subtracted from VX. VF is set to 0 when theres a borrow, and 1 when there is not.')
-            x = self.get_x(opcode)
-            y = self.get_y(opcode)
-            no_borrow = self.V[x] >= self.V[y]
-            self.V[x] = (self.V[x] - self.V[y]) & 0xFF
-            self.V[0xF] = 1 if no_borrow else 0  # No borrow -> VF = 1
-
-            self.increment_pc() 
-        elif opcode & 0xF00F == 0x8006:
-            #print('	Stores the least significant bit of VX in VF and then shifts VX to the right by 1.[b]')
-            x = self.get_x(opcode)
-            y = self.get_y(opcode)
-            flag = self.V[x] & 0x1
-
-            if self.shifting:
-                self.V[x] >>= 1
-            else:
-                self.V[x] = self.V[y] >> 1
-
-            self.V[0xF] = flag
-            self.increment_pc()
-        elif opcode & 0xF00F == 0x8007:
-            #print('Sets VX to VY minus VX. VF is set to 0 when theres a borrow, and 1 when there is not.')
-            x = self.get_x(opcode)
-            y = self.get_y(opcode)
-            no_borrow = self.V[x] <= self.V[y]
-            self.V[x] = (self.V[y] - self.V[x]) & 0xFF
-            self.V[0xF] = 1 if no_borrow else 0  # No borrow -> VF = 1
-
-            self.increment_pc() 
-        elif opcode & 0xF00F == 0x800E:
-            #print('Stores the most significant bit of VX in VF and then shifts VX to the left by 1.[b]')
-            x = self.get_x(opcode)
-            y = self.get_y(opcode)
-            flag = (self.V[x] & 0x80) >> 7
-
-            if self.shifting:
-                self.V[x] = (self.V[x] << 1) & 0xFF
-            else:
-                self.V[x] = (self.V[y] << 1) & 0xFF
-
-            self.V[0xF] = flag
-            self.increment_pc()
-
-        # STARTING WITH 9
-        elif opcode & 0xF00F == 0x9000:
-            # print('Skips the next instruction if VX does not equal VY. (Usually the next instruction is a jump to skip a code block);')
-            if self.V[self.get_x(opcode)] != self.V[self.get_y(opcode)]:
-                self.skip_next_instruction = True
-            self.increment_pc()
-
-        # STARTING WITH A
-        elif opcode & 0xF000 == 0xA000:
-            # print(f'sets I to the address {hex(opcode&0x0FFF)}')
-            self.I = self.get_nnn(opcode)
-            self.increment_pc()
-        
-        # STARTING WITH B
-        elif opcode & 0xF000 == 0xB000:
-            # print(f'jumps to the address {hex(opcode&0x0FFF)} plus V0')
-            if self.jumping:
-                x = (self.get_nnn(opcode) & 0xF00) >> 8
-                self.PC = self.get_nnn(opcode) + self.V[x]
+        if self.clipping:
+            self.draw_sprite_clipped(x, y, height, sprite_width)
+        else:
+            self.draw_sprite_wrapped(x, y, height, sprite_width)
+
+    def sprite_rows(self, height, sprite_width):
+        if sprite_width == 8:
+            return self.read_memory(self.I, height)
+        data = self.read_memory(self.I, 2*height)
+        return [(high << 8) | low for high, low in zip(data[::2], data[1::2])]
+
+    def draw_sprite_clipped(self, x, y, height, sprite_width=8):
+        """draw_sprite with the clipping quirk, rows and columns past the edges are dropped."""
+        videosystem = self.videosystem
+        pixels = videosystem.pixels
+        width, screen_height = videosystem.width, videosystem.height
+        x %= width
+        y %= screen_height
+
+        # shift that puts the sprite row at column x, negative once it runs off the right edge
+        shift = width - sprite_width - x
+        collision = 0
+        for row, sprite_bits in enumerate(self.sprite_rows(min(height, screen_height - y), sprite_width)):
+            bits = sprite_bits << shift if shift >= 0 else sprite_bits >> -shift
+            line = pixels[y + row]
+            if line & bits:
+                collision = 1
+            pixels[y + row] = line ^ bits
+
+        self.V[0xF] = collision
+
+    def draw_sprite_wrapped(self, x, y, height, sprite_width=8):
+        """draw_sprite without the clipping quirk, rows and columns past the edges wrap around."""
+        videosystem = self.videosystem
+        pixels = videosystem.pixels
+        width, screen_height = videosystem.width, videosystem.height
+        row_mask = (1 << width) - 1
+        x %= width
+        y %= screen_height
+
+        shift = width - sprite_width - x
+        wrap_shift = width + shift
+        collision = 0
+        for row, sprite_bits in enumerate(self.sprite_rows(height, sprite_width)):
+            pixel_y = (y + row) % screen_height
+            if shift >= 0:
+                bits = sprite_bits << shift
             else:
-                self.PC = self.get_nnn(opcode) + self.V[0]
-        
-        # STARTING WITH C
-        elif opcode & 0xF000 == 0xC000:
-            # print('sets VX to the result of a bitwise and operation on a random number (typically 0 to 255) and NN')
-            self.V[self.get_x(opcode)] = random.randint(0, 255)&self.get_nn(opcode)
-            self.maskV(self.get_x(opcode))
-            self.increment_pc()
-        
-        # STARTING WITH D
-        elif opcode & 0xF000 == 0xD000:
-            # print('Draws a sprite at coordinate (VX, VY) that has a width of 8 pixels and a height of N pixels. Each row of 8 pixels is read as bit-coded starting from memory location I; I value does not change after the execution of this instruction. As described above, VF is set to 1 if any screen pixels are flipped from set to unset when the sprite is drawn, and to 0 if that does not happen')
-            x = self.V[self.get_x(opcode)]
-            y = self.V[self.get_y(opcode)]
-            n = self.get_n(opcode)
-            self.draw_sprite(x, y, n)
-            self.increment_pc()
-
-        # STARTING WITH E
-        elif opcode & 0xF0FF == 0xE09E:
-            #print('Skips the next instruction if the key stored in VX is pressed. (Usually the next instruction is a jump to skip a code block);')
-            if self.V[self.get_x(opcode)] in self.get_pressed_chip8_keys():
-                self.skip_next_instruction = True
-            self.increment_pc()
-
-        elif opcode & 0xF0FF == 0xE0A1:
-            #print('Skips the next instruction if the key stored in VX is not pressed. (Usually the next instruction is a jump to skip a code block);')
-            if self.V[self.get_x(opcode)] not in self.get_pressed_chip8_keys():
-                self.skip_next_instruction = True
-            self.increment_pc()
-
-        # STARTING WITH F
-        elif opcode & 0xF0FF == 0xF007:
-            #print('Sets VX to the value of the delay timer.')
-            self.V[self.get_x(opcode)] = self.DT
-            self.increment_pc()
-        elif opcode & 0xF0FF == 0xF00A:
-            #print('A key press is awaited, and then stored in VX. (Blocking Operation. All instruction halted until next key event);')
-
-            x = self.get_x(opcode)
-            print('waiting for key press...')
-            key_pressed = False
-            key_released = False
-            while not key_released:
-                for event in pygame.event.get():
-                    if event.type == pygame.QUIT:
-                        self.run = False
-                        break
+                bits = (sprite_bits >> -shift) | ((sprite_bits << wrap_shift) & row_mask)
 
-                    if event.type == pygame.KEYDOWN:
-                        key = event.key
-                        if key in self.key_map:
-                            self.V[x] = self.key_map[key]
-                            key_pressed = True
-                            
-                    if event.type == pygame.KEYUP and key_pressed:
-                        key_released = True
-                
-                if self.DT > 0:
-                    self.DT -= 1
-
-                if self.run == False:
-                    break
-                pygame.time.delay(10)
-            self.increment_pc()
-        elif opcode & 0xF0FF == 0xF015:
-            #print('Sets the delay timer to VX.')
-            self.DT = self.V[self.get_x(opcode)]
-            self.increment_pc()
-        elif opcode & 0xF0FF == 0xF018:
-            #print('Sets the sound timer to VX.')
-            self.ST = self.V[self.get_x(opcode)]
-            self.increment_pc()
-        elif opcode & 0xF0FF == 0xF01E:
-            # print('Adds VX to I. VF is not affected.[c]')
-            self.I += self.V[self.get_x(opcode)]
-            self.increment_pc()
-        elif opcode & 0xF0FF == 0xF029:
-            # print('Sets I to the location of the sprite for the character in VX. Characters 0-F (in hexadecimal) are represented by a 4x5 font.')
-            digit = self.V[self.get_x(opcode)]
-            self.I = 0x50 + (digit * 5)
-            self.increment_pc()
-        elif opcode & 0xF0FF == 0xF033:
-            #print('Stores the binary-coded decimal representation of VX, with the most significant of three digits at the address in I, the middle digit at I plus 1, and the least significant digit at I plus 2. (In other words, take the decimal representation of VX, place the hundreds digit in memory at location in I, the tens digit at location I+1, and the ones digit at location I+2.);')
-            x = self.get_x(opcode)
-            value = self.V[x]
-
-            self.memory[self.I]     = value // 100        
-            self.memory[self.I + 1] = (value // 10) % 10 
-            self.memory[self.I + 2] = value % 10
-            self.increment_pc() 
-        elif opcode & 0xF0FF == 0xF055:
-            #print('Stores from V0 to VX (including VX) in memory, starting at address I. The offset from I is increased by 1 for each value written, but I itself is left unmodified.[d]')
-            x = self.get_x(opcode)
-
-            for i in range(x+1):
-                self.memory[self.I+i] = self.V[i]
-
-            if self.memory_i_inc:
-                self.I += x+1
-            self.increment_pc()
-        elif opcode & 0xF0FF == 0xF065:
-            #print('Fills from V0 to VX (including VX) with values from memory, starting at address I. The offset from I is increased by 1 for each value written, but I itself is left unmodified.[d]')
-            x = self.get_x(opcode)
-
-            for i in range(x+1):
-                self.V[i] = self.memory[self.I+i]
-
-            if self.memory_i_inc:
-                self.I += x+1
-
-            self.increment_pc()
-
-        # OPCODE NOT FOUND
+            line = pixels[pixel_y]
+            if line & bits:
+                collision = 1
+            pixels[pixel_y] = line ^ bits
+
+        self.V[0xF] = collision
+
+    def execute_opcode(self, opcode):
+        self.dispatch[opcode](self)
+
+    def execute_cycles(self, cycles):
+        """
+        Executes up to `cycles` instructions with the selected engine and
+        returns how many ran. The batch must not cross a frame boundary,
+        idle loops are fast-forwarded on the assumption that DT holds still.
+        """
+        if self.running and self.idle_skip and self.skip_idle_loop(cycles):
+            return cycles
+        if self.block_cache is not None:
+            return self.block_cache.execute_cycles(cycles)
+
+        dispatch = self.dispatch
+        memory = self.memory
+        for done in range(cycles):
+            if not self.running:
+                return done
+            pc = self.PC
+            dispatch[(memory[pc] << 8) | memory[pc+1]](self)
+        return cycles
+
+    def skip_idle_loop(self, cycles):
+        """
+        Fast-forwards `cycles` instructions if PC sits in an idle loop that
+        nothing inside a frame can leave: a jump to itself, or the Fx07 /
+        3xkk / 1NNN loop waiting for the delay timer to reach kk. PC and VX
+        end up exactly where stepping would have left them. Returns False,
+        without touching anything, when PC is not in such a loop.
+        """
+        memory = self.memory
+        pc = self.PC
+        opcode = (memory[pc] << 8) | memory[pc+1]
+        if opcode == 0x1000 | pc:
+            self.idle_loop = 'jump'
+            self.idle_cycles += cycles
+            return True
+
+        # find the start of the delay loop from whichever of its instructions PC is on
+        if opcode & 0xF0FF == 0xF007:
+            start = pc
+        elif opcode & 0xF000 == 0x3000:
+            start = pc - 2
+        elif opcode & 0xF000 == 0x1000 and opcode & 0x0FFF == pc - 4:
+            start = pc - 4
         else:
-            print(f'UNKNOWN OPCODE --- {hex(opcode)} --- UNKOWN OPCODE')
-            self.increment_pc()
+            self.idle_loop = None
+            return False
+
+        load = (memory[start] << 8) | memory[start+1]
+        x = (load & 0x0F00) >> 8
+        test = (memory[start+2] << 8) | memory[start+3]
+        jump = (memory[start+4] << 8) | memory[start+5]
+        kk = test & 0x00FF
+        position = (pc - start) // 2
+        if (load & 0xF0FF != 0xF007 or test & 0xFF00 != 0x3000 | (x << 8) or jump != 0x1000 | start
+                or start + 4 >= self.pc_limit or self.DT == kk or (position == 1 and self.V[x] == kk)):
+            self.idle_loop = None
+            return False
+
+        # Fx07 runs at the steps where the position comes round to 0
+        if cycles > (3 - position) % 3:
+            self.V[x] = self.DT
+        self.PC = start + 2 * ((position + cycles) % 3)
+        self.idle_loop = 'timer'
+        self.idle_cycles += cycles
+        return True
+
+    def wait_for_key(self, x):
+        """
+        Fx0A without blocking. Every execution checks the sampled keys once
+        and returns True when a key that went down after the wait started has
+        been released again, VX then holds it. Until then the instruction
+        repeats while frames, timers and presentation carry on as usual.
+        """
+        keypad = self.keypad
+        if self.key_wait is None:
+            # keys already held when the wait starts do not count
+            self.key_wait = x
+            self.key_wait_held = keypad
+            self.key_wait_value = None
+        elif self.key_wait_value is None:
+            fresh = keypad & ~self.key_wait_held
+            if fresh:
+                self.key_wait_value = (fresh & -fresh).bit_length() - 1   # lowest new key
+            self.key_wait_held = keypad
+        elif not (keypad >> self.key_wait_value) & 1:
+            self.V[x] = self.key_wait_value
+            self.key_wait = None
+            return True
+        return False
 
     def increment_pc(self):
-        self.PC += 2
-        if self.PC > len(self.memory)-1:
-            self.run = False
-        if self.PC >= self.start_address + self.rom_size + 1:
-            self.run = False
-
-    def _mask8(self, value):
-        return value & 0xFF
+        _next(self, 2)
 
     def print_memory(self):
         print(self.memory)
 
-    def main_loop(self, clock):
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                self.run = False
-                
-
-        if self.run:
-            opcode = self.get_opcode()
-
-            self.execute_opcode(opcode)
-
-            if self.skip_next_instruction:
-                self.increment_pc()
-                self.skip_next_instruction = False
-
-            clock.tick(500)
+    def count_cycles(self, executed):
+        """Accounts for executed instructions and ends the frame once its batch has run."""
+        self.cycles += executed
+        self.frame_cycles += executed
+        if self.frame_cycles >= self.instructions_per_frame:
+            self.frame_cycles = 0
+            self.frames += 1
+            self.tick_timers()
+
+    def tick_timers(self):
+        if self.DT > 0:
+            self.DT -= 1
+        if self.ST > 0:
+            self.audio_backend.play()
+            self.ST -= 1
+        else:
+            self.audio_backend.stop()
 
-            if self.decrement_timers_timer >= self.decrement_timers:
-                if self.DT > 0:
-                    self.DT -= 1
-                if self.ST > 0:
-                    if not self.playing_sound:
-                        self.sound.play(-1)
-                        self.playing_sound = True
+    def cycles_to_frame_end(self):
+        return self.instructions_per_frame - self.frame_cycles
 
-                    self.ST -= 1
+    def run_frame(self):
+        """Runs the rest of the current frame's instruction batch and ticks the timers."""
+        self.count_cycles(self.execute_cycles(self.cycles_to_frame_end()))
 
-                else:
-                    if self.playing_sound:
-                        self.sound.stop()
-                        self.playing_sound = False
-                self.decrement_timers_timer = 1
+    def main_loop(self):
+        """
+        Runs one frame: polls events once, emulates, presents once and sleeps
+        until the next frame. In turbo a frame here is several emulated ones.
+        """
+        for event in self.input_backend.poll(self.cycles):
+            if event.type == pygame.QUIT:
+                self.running = False
+            self.handle_event(event)
+            self.videosystem.handle_event(event)
+        self.keypad = self.input_backend.keypad
+
+        if self.running:
+            if self.rewinding:
+                self.rewind_buffer.rewind(self)
             else:
-                self.decrement_timers_timer += 1
+                # in turbo the frames in between are emulated, timers and sound included, but never drawn
+                deadline = time.perf_counter() + self.scheduler.frame_time
+                emulated = 0
+                while True:
+                    self.run_frame()
+                    if self.rewind_buffer is not None:
+                        self.rewind_buffer.push(self)
+                    emulated += 1
+                    if not self.running or self.key_wait is not None or self.idle_loop == 'jump':
+                        break
+                    if emulated == self.turbo or (self.turbo is None and time.perf_counter() >= deadline):
+                        break
+            self.videosystem.present()
+            if self.key_wait is not None or self.idle_loop == 'jump':
+                # nothing can happen until a key arrives, sleep on the input instead of the clock
+                self.scheduler.wait(self.input_backend.wait_event)
+            elif self.turbo is not None:
+                self.scheduler.wait()
+
+    def handle_event(self, event):
+        """
+        Emulator hotkeys: F5 saves the state to the states folder, F9 loads it,
+        backspace rewinds, Tab cycles the turbo speed and F3 toggles telemetry.
+        """
+        if event.type == pygame.KEYDOWN:
+            if event.key == pygame.K_TAB:
+                self.turbo = turbo_speeds[(turbo_speeds.index(self.turbo) + 1) % len(turbo_speeds)]
+                # pace from now on rather than catching up with the old speed's deadlines
+                self.scheduler.next_frame = None
+                pygame.display.set_caption(f"CHIP-8 {'uncapped' if self.turbo is None else f'{self.turbo}x'}")
+            elif event.key == pygame.K_F3:
+                self.toggle_telemetry()
+            elif event.key == pygame.K_F5 and self.rom_path is not None:
+                write_state(self, state_path(self.rom_path))
+            elif event.key == pygame.K_F9 and self.rom_path is not None and os.path.exists(state_path(self.rom_path)):
+                read_state(self, state_path(self.rom_path))
+            elif event.key == pygame.K_BACKSPACE and self.rewind_buffer is not None:
+                self.rewinding = True
+        elif event.type == pygame.KEYUP and event.key == pygame.K_BACKSPACE:
+            self.rewinding = False
+
+    def toggle_telemetry(self):
+        if self.telemetry is None:
+            self.telemetry = Telemetry()
+            self.telemetry.attach(self)
+        else:
+            self.telemetry.detach()
+            self.telemetry = None
+
+    def run(self, cycles):
+        """
+        Executes `cycles` instructions as fast as possible, without handling
+        window events or pacing, and returns the resulting machine state.
+        Input is still sampled once at the start of every frame.
+        """
+        remaining = cycles
+        while remaining > 0 and self.running:
+            if self.frame_cycles == 0:
+                self.input_backend.poll(self.cycles)
+                self.keypad = self.input_backend.keypad
+            executed = self.execute_cycles(min(remaining, self.cycles_to_frame_end()))
+            self.count_cycles(executed)
+            remaining -= executed
+        return self.state()
+
+    def run_until(self, predicate, max_cycles=None):
+        """
+        Executes instructions until predicate(cpu) is true, checked after every
+        instruction, or until max_cycles ran. Returns the resulting machine state.
+        """
+        executed = 0
+        while self.running and not predicate(self):
+            if max_cycles is not None and executed >= max_cycles:
+                break
+            if self.frame_cycles == 0:
+                self.input_backend.poll(self.cycles)
+                self.keypad = self.input_backend.keypad
+            self.count_cycles(self.execute_cycles(1))
+            executed += 1
+        return self.state()
+
+    def state(self):
+        return {
+            'pixels': list(self.videosystem.pixels),
+            'V': list(self.V),
+            'I': self.I,
+            'PC': self.PC,
+            'stack': self.stack[:self.SP],
+            'DT': self.DT,
+            'ST': self.ST,
+            'cycles': self.cycles,
+            'running': self.running,
+        }
 
 
 if __name__ == '__main__':
-    pygame.init()
-    pygame.mixer.init()
+    # the mixer starts on the first beep
+    pygame.display.init()
 
     vf_reset = False
     memory_i_inc = False
@@ -580,7 +994,7 @@ if __name__ == '__main__':
     shifting = True
     jumping = True
 
-    cpu = CPU(vf_reset, memory_i_inc, clipping, shifting, jumping, None)
+    cpu = CPU(vf_reset, memory_i_inc, clipping, shifting, jumping, None, rewind_seconds=120)
 
     #cpu.load_rom('tests/1-chip8-logo.ch8')
     #cpu.load_rom('tests/2-ibm-logo.ch8')
@@ -593,8 +1007,7 @@ if __name__ == '__main__':
 
     cpu.load_rom('games/BRIX')
 
-    clock = pygame.time.Clock()
-    while cpu.run:
-        cpu.main_loop(clock)
+    while cpu.running:
+        cpu.main_loop()
     pygame.quit()
 
@@ -1,9 +1,33 @@
-from emulator import CPU, VideoSystem, emu_width, emu_height, emu_scale
+from emulator import CPU, VideoSystem, default_quirks, emu_width, emu_height, emu_scale
+from quirk_sweep import load_quirk_db
+from rom_library import RomLibrary
 import pygame
 import os
 
-pygame.init()
-pygame.mixer.init()
+# the mixer starts on the first beep of a game
+pygame.display.init()
+pygame.font.init()
+
+def thumbnail_surface(data, height, on_color=(0, 255, 220), off_color=(10, 10, 40)):
+    """Turns a framebuffer stored by the ROM library into a surface `height` pixels high."""
+    pixels = int.from_bytes(bytes.fromhex(data), 'big')
+    size = emu_width * emu_height
+    rgb = b''.join(bytes(on_color) if (pixels >> (size - 1 - i)) & 1 else bytes(off_color) for i in range(size))
+    surface = pygame.image.frombuffer(rgb, (emu_width, emu_height), 'RGB')
+    return pygame.transform.scale(surface, (height * emu_width // emu_height, height))
+
+
+# one font for every label, SysFont searches the installed fonts each time it is called
+label_font = pygame.font.SysFont('fixed sys', 32)
+_labels = {}
+
+def label(text, color):
+    """Renders a label once, later calls with the same text and colour get the same surface."""
+    surface = _labels.get((text, color))
+    if surface is None:
+        surface = _labels[text, color] = label_font.render(text, True, color)
+    return surface
+
 
 class Button:
     def __init__(self, x, y, width, height, text, bg_color, txt_color, selected_color, script_name):
@@ -17,22 +41,107 @@ class Button:
         self.selected_color = selected_color
         self.current_color = self.bg_color
 
-        self.font = pygame.font.SysFont('fixed sys', 32)
-        self.text_surface = self.font.render(self.text, True, self.txt_color)
+        self.text_surface = label(self.text, self.txt_color)
 
 
     def draw(self, screen:pygame.surface.Surface, offset_y):
         pygame.draw.rect(screen, self.current_color, (self.rect.x, self.rect.y+offset_y, self.rect.width, self.rect.height))
         screen.blit(self.text_surface, (self.rect.x + self.rect.width / 2 - self.text_surface.get_width()/2, self.rect.y + self.rect.height / 2 - self.text_surface.get_height()/2 + offset_y))
 
-    def update(self, mouse, mouse_click, button_offset):
-        if pygame.Rect(self.rect.x, self.rect.y+button_offset, self.rect.width, self.rect.height).collidepoint(mouse[0], mouse[1]):
-            self.current_color = self.selected_color
-            if mouse_click:
-                return True
-        else:
-            self.current_color = self.bg_color
+    def hover(self, mouse, offset_y=0):
+        """Highlights the button when the mouse is over it, returns True if that changed how it looks."""
+        color = self.selected_color if self.rect.move(0, offset_y).collidepoint(mouse) else self.bg_color
+        changed = color != self.current_color
+        self.current_color = color
+        return changed
+
+
+class RomList:
+    """
+    The ROM buttons, two to a row. Rows are laid out arithmetically, so only
+    the ones inside the window are drawn and hit-tested however long the
+    list is. Labels and thumbnails are rendered when their row first comes
+    into view, and draw() is only needed while `dirty` is set.
+    """
+    columns, row_height, spacing, margin = 2, 50, 10, 20
+
+    def __init__(self, size, paths, library, bg_color, txt_color, selected_color):
+        self.width, self.height = size
+        self.library = library
+        self.names = [os.path.basename(path) for path in paths]
+        self.sha1s = [library.files[path]['sha1'] for path in paths]
 
+        self.bg_color = bg_color
+        self.txt_color = txt_color
+        self.selected_color = selected_color
+
+        self.column_width = (self.width - self.margin*2 - self.spacing*(self.columns-1)) / self.columns
+        self.pitch = self.row_height + self.spacing
+        rows = -(-len(paths) // self.columns)
+        self.max_scroll = max(0, self.margin*2 + rows*self.pitch - self.spacing - self.height)
+
+        self.thumbnails = {}    # sha1 -> surface
+        self.scroll = 0         # pixels scrolled down from the top
+        self.hovered = None
+        self.dirty = True
+
+    def visible(self):
+        """Indices of the items at least partly inside the window."""
+        first_row = max(0, (self.scroll - self.margin) // self.pitch)
+        last_row = (self.scroll + self.height - self.margin) // self.pitch
+        return range(first_row * self.columns, min(len(self.names), (last_row + 1) * self.columns))
+
+    def item_rect(self, index):
+        row, column = divmod(index, self.columns)
+        return pygame.Rect(self.margin + column * (self.column_width + self.spacing),
+                           self.margin + row * self.pitch - self.scroll, self.column_width, self.row_height)
+
+    def item_at(self, position):
+        """The index of the item under a window position, None between and beyond the buttons."""
+        x, y = position
+        row, row_y = divmod(y + self.scroll - self.margin, self.pitch)
+        column, column_x = divmod(x - self.margin, self.column_width + self.spacing)
+        if row < 0 or row_y >= self.row_height or not 0 <= column < self.columns or column_x >= self.column_width:
+            return None
+        index = int(row) * self.columns + int(column)
+        return index if index < len(self.names) else None
+
+    def scroll_by(self, pixels):
+        scroll = min(max(self.scroll + pixels, 0), self.max_scroll)
+        if scroll != self.scroll:
+            self.scroll = scroll
+            self.dirty = True
+
+    def hover(self, position):
+        index = self.item_at(position)
+        if index != self.hovered:
+            self.hovered = index
+            self.dirty = True
+
+    def thumbnail_ready(self, sha1):
+        self.thumbnails.pop(sha1, None)
+        if any(self.sha1s[index] == sha1 for index in self.visible()):
+            self.dirty = True
+
+    def thumbnail(self, sha1):
+        surface = self.thumbnails.get(sha1)
+        if surface is None:
+            data = self.library.roms[sha1]['thumbnail']
+            if data is not None:
+                surface = self.thumbnails[sha1] = thumbnail_surface(data, self.row_height - 10)
+        return surface
+
+    def draw(self, screen):
+        for index in self.visible():
+            rect = self.item_rect(index)
+            pygame.draw.rect(screen, self.selected_color if index == self.hovered else self.bg_color, rect)
+            thumbnail = self.thumbnail(self.sha1s[index])
+            if thumbnail is not None:
+                margin = (rect.height - thumbnail.get_height()) // 2
+                screen.blit(thumbnail, (rect.x + margin, rect.y + margin))
+            text_surface = label(self.names[index], self.txt_color)
+            screen.blit(text_surface, text_surface.get_rect(center=rect.center))
+        self.dirty = False
 
 
 class Launcher:
@@ -44,6 +153,10 @@ class Launcher:
 
         self.clock = pygame.time.Clock()
 
+        # starts from the saved index, thumbnails that are missing render in the background
+        self.library = RomLibrary()
+        self.quirk_db = load_quirk_db()
+
 
     def launch_type_menu_loop(self):
         buttons = []
@@ -54,115 +167,88 @@ class Launcher:
         buttons.append(games_button)
         buttons.append(tests_button)
 
-        button_offset = 0
-
-        mouse_clicked = False
+        # the screen is only redrawn when a button's highlight changes
+        dirty = True
         while self.run:
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
                     self.run = False
                     break
 
-                if event.type == pygame.MOUSEBUTTONDOWN:
-                    mouse_clicked = True
-                if event.type == pygame.MOUSEBUTTONUP:
-                    mouse_clicked = False
+                if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+                    for button in buttons:
+                        if button.rect.collidepoint(event.pos):
+                            script_name = button.script_name
+                            if script_name[0] == '/':
+                                return script_name[1:]
+                            else:
+                                print('why script in menu?')
 
+            mouse = pygame.mouse.get_pos()
             for button in buttons:
-                if button.update(pygame.mouse.get_pos(), mouse_clicked, button_offset):
-                    script_name = button.script_name
-                    if script_name[0] == '/':
-                        return script_name[1:]
-                    else:
-                        print('why script in menu?')
-
-            self.screen.fill((30, 30, 60))
-            for button in buttons:
-                button.draw(self.screen, button_offset)
-            pygame.display.update()
+                if button.hover(mouse):
+                    dirty = True
+
+            if dirty:
+                self.screen.fill((30, 30, 60))
+                for button in buttons:
+                    button.draw(self.screen, 0)
+                pygame.display.update()
+                dirty = False
             self.clock.tick(60)
 
     def select_script_loop(self, folder):
-        buttons = []
-        i = 0
-        margin = 20
-        margin_between_buttons = 10
-
-        button_offset = 0
-        loop_run = True
-
-        for f in os.listdir(folder):
-            if os.path.isfile(os.path.join(folder, f)):
-                if i % 2 == 0: # EVEN
-                    x = margin
-                    height = 50
-                    y = margin + i/2*height + i*margin_between_buttons/2
-                    width = (self.screen_width - margin*2)/2 - margin_between_buttons/2
-                else: # ODD
-                    width = (self.screen_width - margin*2)/2 - margin_between_buttons/2
-                    x = self.screen_width - width - margin
-                    y = margin + (i-1)/2*height + (i-1)*margin_between_buttons/2
-                    height = 50
-                    
-                buttons.append(Button(x, y, width, height, f, (10, 10, 40), (0, 255, 220), (0, 0, 30), f))
-
-                i += 1
-
-
-        mouse_clicked = False
-        while loop_run:
+        paths = self.library.scan(folder)
+        self.library.render_missing(paths)
+
+        rom_list = RomList(self.screen.get_size(), paths, self.library, (10, 10, 40), (0, 255, 220), (0, 0, 30))
+
+        while True:
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
-                    loop_run = False
-                    break
+                    return None
 
-                if event.type == pygame.MOUSEBUTTONDOWN:
-                    mouse_clicked = True
-                if event.type == pygame.MOUSEBUTTONUP:
-                    mouse_clicked = False
+                if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+                    index = rom_list.item_at(event.pos)
+                    if index is not None:
+                        return rom_list.names[index]
 
                 if event.type == pygame.MOUSEWHEEL:
-                    button_offset += event.y*30
-                    if button_offset > 0:
-                        button_offset = 0
-
+                    rom_list.scroll_by(-event.y*30)
 
-            for button in buttons:
-                if button.update(pygame.mouse.get_pos(), mouse_clicked, button_offset):
-                    script_name = button.script_name
-                    if script_name[0] != '/':
-                        return script_name
-                    else:
-                        print('why folder in script selection?')
+            for sha1 in self.library.poll():
+                rom_list.thumbnail_ready(sha1)
 
+            rom_list.hover(pygame.mouse.get_pos())
 
-            self.screen.fill((30, 30, 60))
-            for button in buttons:
-                button.draw(self.screen, button_offset)
-            pygame.display.update()
+            if rom_list.dirty:
+                self.screen.fill((30, 30, 60))
+                rom_list.draw(self.screen)
+                pygame.display.update()
             self.clock.tick(60)
 
-launcher = Launcher()
+if __name__ == '__main__':
+    launcher = Launcher()
 
-pygame.display.update()
-while launcher.run:
-    folder = launcher.launch_type_menu_loop()
-    if folder == None:
-        continue
-    game = launcher.select_script_loop(folder)
+    pygame.display.update()
+    while launcher.run:
+        folder = launcher.launch_type_menu_loop()
+        if folder == None:
+            continue
+        game = launcher.select_script_loop(folder)
 
-    if game == None:
-        continue
+        if game == None:
+            continue
 
-    vf_reset = False
-    memory_i_inc = False
-    clipping = True
-    shifting = True
-    jumping = True
+        # quirks come from the quirk database when they were curated there, else every ROM runs with the defaults
+        path = os.path.join(folder, game)
+        swept = launcher.quirk_db.get(launcher.library.files[path]['sha1'])
+        quirks = swept['quirks'] if swept and swept.get('curated') else default_quirks
 
-    cpu = CPU(vf_reset, memory_i_inc, clipping, shifting, jumping, launcher.screen)
-    cpu.load_rom(os.path.join(folder, game))
-    while cpu.run:
-        cpu.main_loop(launcher.clock)
+        cpu = CPU(**quirks, screen=launcher.screen, rewind_seconds=120)
+        cpu.load_rom(path)
+        while cpu.running:
+            cpu.main_loop()
 
-pygame.quit()
+    launcher.library.close()
+    pygame.quit()
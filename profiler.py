@@ -0,0 +1,188 @@
+import os
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import argparse
+import collections
+import contextlib
+import io
+import json
+import sys
+import time
+
+from backends import ScriptedInput
+from conformance import game_script, scripts
+from emulator import CPU, default_quirks
+
+# Opt-in instrumentation. Attaching swaps the CPU's dispatch table, the video
+# backend's present() and the scheduler's wait() for timed wrappers, and
+# detaching puts the originals back, so an unprofiled CPU runs exactly the
+# code it always runs. Idle loops are stepped rather than fast-forwarded
+# while attached, so their instructions show up at their PCs.
+#
+#   python profiler.py games/BRIX --json brix.json --collapsed brix.folded
+
+
+def opcode_family(opcode):
+    """Names the family an opcode belongs to, in the usual 8xy4 / Fx33 notation."""
+    top = opcode >> 12
+    if opcode in (0x00E0, 0x00EE):
+        return f'{opcode:04X}'
+    if top == 0x0:
+        return '0nnn'
+    if top in (0x1, 0x2, 0xA, 0xB):
+        return f'{top:X}nnn'
+    if top in (0x3, 0x4, 0x6, 0x7, 0xC):
+        return f'{top:X}xkk'
+    if top in (0x5, 0x9):
+        return f'{top:X}xy{opcode & 0xF:X}'
+    if top == 0x8:
+        return f'8xy{opcode & 0xF:X}'
+    if top == 0xD:
+        return 'Dxyn'
+    return f'{top:X}x{opcode & 0xFF:02X}'
+
+
+class ProfiledDispatch:
+    """Stands in for the dispatch table and hands out timed wrappers around its handlers."""
+    def __init__(self, profiler, table):
+        self.profiler = profiler
+        self.table = table
+        self.wrappers = {}
+
+    def __getitem__(self, opcode):
+        wrapper = self.wrappers.get(opcode)
+        if wrapper is None:
+            wrapper = self.wrappers[opcode] = self.profiler.wrap_handler(opcode, self.table[opcode])
+        return wrapper
+
+
+class Profiler:
+    def __init__(self):
+        self.cpu = None
+        self.opcodes = collections.defaultdict(lambda: [0, 0.0])   # family -> [count, seconds]
+        self.hot_pcs = collections.Counter()
+        self.draws_by_frame = collections.Counter()
+        self.emulation_time = 0.0
+        self.render_time = 0.0
+        self.sleep_time = 0.0
+        self.frames = 0
+
+    def attach(self, cpu):
+        if cpu.block_cache is not None:
+            raise ValueError('per-opcode profiling needs the interpreter engine')
+        self.cpu = cpu
+        self.start_time = time.perf_counter()
+        self.start_frame = cpu.frames
+        self.table = cpu.dispatch
+        self.present = cpu.videosystem.present
+        self.wait = cpu.scheduler.wait
+        self.idle_skip = cpu.idle_skip
+
+        cpu.idle_skip = False
+        cpu.dispatch = ProfiledDispatch(self, self.table)
+        cpu.videosystem.present = self.timed_present
+        cpu.scheduler.wait = self.timed_wait
+
+    def detach(self):
+        cpu = self.cpu
+        self.wall_time = time.perf_counter() - self.start_time
+        self.frames = cpu.frames - self.start_frame
+        cpu.dispatch = self.table
+        cpu.idle_skip = self.idle_skip
+        del cpu.videosystem.present
+        del cpu.scheduler.wait
+        self.cpu = None
+
+    def wrap_handler(self, opcode, handler):
+        stats = self.opcodes[opcode_family(opcode)]
+        hot_pcs = self.hot_pcs
+        perf_counter = time.perf_counter
+        is_draw = opcode >> 12 == 0xD
+        profiler = self
+
+        def profiled(cpu):
+            hot_pcs[cpu.PC] += 1
+            if is_draw:
+                profiler.draws_by_frame[cpu.frames] += 1
+            start = perf_counter()
+            handler(cpu)
+            elapsed = perf_counter() - start
+            stats[0] += 1
+            stats[1] += elapsed
+            profiler.emulation_time += elapsed
+        return profiled
+
+    def timed_present(self):
+        start = time.perf_counter()
+        self.present()
+        self.render_time += time.perf_counter() - start
+
+    def timed_wait(self, idle=None):
+        start = time.perf_counter()
+        self.wait(idle)
+        self.sleep_time += time.perf_counter() - start
+
+    def draws_per_frame(self):
+        """Histogram of draw calls per frame, frames without draws included."""
+        histogram = collections.Counter(self.draws_by_frame.values())
+        histogram[0] = max(0, self.frames - len(self.draws_by_frame))
+        return dict(sorted(histogram.items()))
+
+    def report(self, top=32):
+        return {
+            'opcodes': {family: {'count': count, 'seconds': seconds}
+                        for family, (count, seconds) in sorted(self.opcodes.items(), key=lambda item: -item[1][1])},
+            'hot_pcs': [[f'0x{pc:03X}', count] for pc, count in self.hot_pcs.most_common(top)],
+            'draws_per_frame': self.draws_per_frame(),
+            'time': {
+                'wall': self.wall_time,
+                'emulation': self.emulation_time,
+                'rendering': self.render_time,
+                'sleeping': self.sleep_time,
+            },
+            'frames': self.frames,
+        }
+
+    def collapsed(self):
+        """Collapsed-stack lines (frame;frame value) in microseconds, as flamegraph tools read them."""
+        lines = [f'main_loop;emulate;{family} {round(seconds * 1e6)}'
+                 for family, (count, seconds) in sorted(self.opcodes.items())]
+        lines.append(f'main_loop;present {round(self.render_time * 1e6)}')
+        lines.append(f'main_loop;sleep {round(self.sleep_time * 1e6)}')
+        return '\n'.join(lines) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Profile a ROM headless by opcode family and PC.')
+    parser.add_argument('rom')
+    parser.add_argument('--frames', type=int, default=3000)
+    parser.add_argument('--json', help='write the report to this JSON file')
+    parser.add_argument('--collapsed', help='write collapsed stacks for flamegraph tools to this file')
+    args = parser.parse_args()
+
+    cpu = CPU(**default_quirks, screen=None, headless=True, seed=0,
+              input_backend=ScriptedInput(scripts.get(args.rom) or game_script()))
+    cpu.load_rom(args.rom)
+    profiler = Profiler()
+    profiler.attach(cpu)
+    with contextlib.redirect_stdout(io.StringIO()):
+        cpu.run(args.frames * cpu.instructions_per_frame)
+    profiler.detach()
+
+    report = profiler.report()
+    for family, stats in list(report['opcodes'].items())[:12]:
+        print(f"{family:<6} {stats['count']:>10} {stats['seconds'] * 1e3:>10.2f} ms")
+    print('hot PCs', ', '.join(f'{pc}:{count}' for pc, count in report['hot_pcs'][:8]))
+    print('draws per frame', report['draws_per_frame'])
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(report, file, indent=4)
+    if args.collapsed:
+        with open(args.collapsed, 'w') as file:
+            file.write(profiler.collapsed())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
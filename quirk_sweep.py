@@ -0,0 +1,149 @@
+import os
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import argparse
+import contextlib
+import hashlib
+import io
+import itertools
+import json
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from backends import ScriptedInput
+from conformance import find_roms, game_script, rom_quirks, scripts
+from emulator import CPU, clear_dispatch_tables, default_quirks
+from rom_library import file_hash
+
+# Runs a ROM headless under all 32 quirk combinations, hashing the framebuffer
+# and memory at the end of every frame. For each flag the runs are paired up
+# with the runs that differ in that flag alone, and the earliest frame where
+# any pair diverges is the cycle at which the flag starts to matter. Flags
+# that never cause a divergence do not matter for that ROM.
+#
+#   python quirk_sweep.py games/BRIX           sweep one ROM
+#   python quirk_sweep.py                      sweep every ROM in tests/ and games/
+#
+# Results go to quirk_db.json keyed by ROM hash. An entry's 'quirks' starts
+# out as the defaults and the launcher only uses it instead of the defaults
+# once 'curated' is true: edit the flags the sweep shows matter, then set it.
+
+quirk_db_path = 'quirk_db.json'
+quirk_flags = list(default_quirks)
+default_cycles = 50000
+
+
+def load_quirk_db(path=quirk_db_path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+
+def run_combination(rom, combination, cycles):
+    """Runs one quirk combination and returns the 8 byte state hash after every frame."""
+    quirks = dict(zip(quirk_flags, combination))
+    cpu = CPU(**quirks, **rom_quirks.get(rom, {}), screen=None, headless=True, seed=0,
+              input_backend=ScriptedInput(scripts.get(rom) or game_script()))
+    cpu.load_rom(rom)
+    videosystem = cpu.videosystem
+    hashes = []
+    with contextlib.redirect_stdout(io.StringIO()):  # unknown opcodes print
+        while cpu.cycles < cycles and cpu.running:
+            cpu.run(min(cpu.cycles_to_frame_end(), cycles - cpu.cycles))
+            state = videosystem.to_bytes() + bytes(cpu.memory)
+            hashes.append(hashlib.blake2b(state, digest_size=8).digest())
+    return combination, cpu.instructions_per_frame, hashes
+
+
+def run_combination_group(roms, combination, cycles):
+    """
+    Runs one quirk combination on every ROM. A worker builds the dispatch
+    table for the combination once and drops it again afterwards, so it
+    never holds more than one.
+    """
+    try:
+        return [run_combination(rom, combination, cycles) for rom in roms]
+    finally:
+        clear_dispatch_tables()
+
+
+def first_divergence(a, b):
+    """Index of the first frame where two hash lists differ, None if they never do."""
+    for frame, (x, y) in enumerate(zip(a, b)):
+        if x != y:
+            return frame
+    if len(a) != len(b):
+        return min(len(a), len(b))
+    return None
+
+
+def analyse(runs, instructions_per_frame):
+    """Maps every flag to the first cycle at which flipping it changes the state, or None."""
+    flags = {}
+    for position, flag in enumerate(quirk_flags):
+        earliest = None
+        for combination, hashes in runs.items():
+            if combination[position]:
+                continue
+            flipped = combination[:position] + (True,) + combination[position+1:]
+            frame = first_divergence(hashes, runs[flipped])
+            if frame is not None and (earliest is None or frame < earliest):
+                earliest = frame
+        flags[flag] = None if earliest is None else (earliest + 1) * instructions_per_frame
+    return flags
+
+
+def sweep(roms, cycles, jobs):
+    """Sweeps every ROM in parallel and returns {rom: {flag: first divergence cycle or None}}."""
+    combinations = list(itertools.product([False, True], repeat=len(quirk_flags)))
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        groups = list(pool.map(run_combination_group, [roms]*len(combinations), combinations,
+                               [cycles]*len(combinations)))
+
+    report = {}
+    for index, rom in enumerate(roms):
+        rom_results = [group[index] for group in groups]
+        runs = {combination: hashes for combination, _, hashes in rom_results}
+        report[rom] = analyse(runs, rom_results[0][1])
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Find which quirk flags change how a ROM runs.')
+    parser.add_argument('roms', nargs='*', help='ROMs to sweep, default is everything in tests/ and games/')
+    parser.add_argument('--cycles', type=int, default=default_cycles)
+    parser.add_argument('--jobs', type=int, default=os.cpu_count())
+    parser.add_argument('--db', default=quirk_db_path)
+    args = parser.parse_args()
+
+    roms = args.roms or find_roms()
+    start = time.perf_counter()
+    report = sweep(roms, args.cycles, args.jobs)
+    elapsed = time.perf_counter() - start
+
+    db = load_quirk_db(args.db)
+    print(f"{'ROM':<24} " + ' '.join(f'{flag:>12}' for flag in quirk_flags))
+    for rom, flags in report.items():
+        print(f'{rom:<24} ' + ' '.join(f"{'-' if cycle is None else cycle:>12}" for cycle in flags.values()))
+        # the quirks conformance needs for a ROM are known to be right, the defaults are only a starting point
+        entry = db.setdefault(file_hash(rom), {'quirks': dict(default_quirks, **rom_quirks.get(rom, {})),
+                                               'curated': rom in rom_quirks})
+        entry.update({
+            'rom': rom,
+            'cycles': args.cycles,
+            'divergence': flags,
+            'matters': [flag for flag, cycle in flags.items() if cycle is not None],
+        })
+    print(f'{len(roms)} ROMs x {2**len(quirk_flags)} combinations in {elapsed:.2f}s, '
+          '- means the flag never changed the framebuffer or memory')
+
+    with open(args.db, 'w') as file:
+        json.dump(db, file, indent=4, sort_keys=True)
+        file.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
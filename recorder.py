@@ -0,0 +1,347 @@
+import os
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import argparse
+import contextlib
+import io
+import json
+import queue
+import struct
+import sys
+import threading
+import time
+import zlib
+
+from backends import ScriptedInput
+from conformance import game_script, rom_quirks, scripts
+from emulator import CPU, default_quirks
+from replay import replay_cpu
+
+# Records the framebuffer of a headless run to disk. The CPU runs uncapped
+# and hands every frame to a writer thread through a bounded queue, so the
+# encoder never runs on the emulation thread. Frames identical to the one
+# before are never queued, the writers only learn how long each distinct
+# frame stayed on screen, so idle stretches cost almost nothing.
+#
+#   python recorder.py games/BRIX brix.gif --frames 600     animated GIF
+#   python recorder.py brix.json brix.raw                   raw frames of a replay log
+#   python recorder.py games/BRIX brix_frames --format png  one PNG per changed frame
+#
+# Raw streams are a 'C8RW' magic and version byte followed by one record per
+# distinct frame: frame number, width and height ('<IHH') and the framebuffer
+# packed 8 pixels per byte. A frame lasts until the next record's frame.
+
+raw_magic = b'C8RW'
+raw_version = 1
+_raw_record = struct.Struct('<IHH')
+
+_expand_tables = {}
+
+def _expand_table(factor):
+    """Every byte with each of its bits repeated `factor` times, as an integer of 8*factor bits."""
+    table = _expand_tables.get(factor)
+    if table is None:
+        table = [int(''.join(bit * factor for bit in f'{byte:08b}'), 2) for byte in range(256)]
+        _expand_tables[factor] = table
+    return table
+
+def scale_rows(pixels, width, factor):
+    """Scales framebuffer rows up by a whole factor, returns the new rows."""
+    if factor == 1:
+        return list(pixels)
+    table = _expand_table(factor)
+    row_bytes = width // 8
+    bits = 8 * factor
+    rows = []
+    for line in pixels:
+        scaled = 0
+        for byte in line.to_bytes(row_bytes, 'big'):
+            scaled = (scaled << bits) | table[byte]
+        rows.extend([scaled] * factor)
+    return rows
+
+
+class RawWriter:
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(raw_magic + bytes([raw_version]))
+
+    def write(self, frame, width, height, pixels):
+        row_bytes = width // 8
+        self.file.write(_raw_record.pack(frame, width, height))
+        self.file.write(b''.join(line.to_bytes(row_bytes, 'big') for line in pixels))
+
+    def close(self, frames):
+        self.file.close()
+
+
+class PngWriter:
+    """
+    One 1-bit palette PNG per distinct frame, named after the frame it first
+    appears on. Frames are scaled to the canvas, so SCHIP resolution changes
+    keep the image size.
+    """
+    def __init__(self, folder, canvas, scale, palette):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.canvas = canvas
+        self.scale = scale
+        self.palette = b''.join(bytes(color) for color in palette)
+
+    def write(self, frame, width, height, pixels):
+        canvas_width, canvas_height = self.canvas
+        factor = self.scale * canvas_width // width
+        image_width = canvas_width * self.scale
+        row_bytes = image_width // 8
+        rows = scale_rows(pixels, width, factor)
+        data = b''.join(b'\x00' + line.to_bytes(row_bytes, 'big') for line in rows)
+
+        header = struct.pack('>IIBBBBB', image_width, len(rows), 1, 3, 0, 0, 0)
+        with open(os.path.join(self.folder, f'frame_{frame:06d}.png'), 'wb') as file:
+            file.write(b'\x89PNG\r\n\x1a\n')
+            for kind, body in ((b'IHDR', header), (b'PLTE', self.palette), (b'IDAT', zlib.compress(data)), (b'IEND', b'')):
+                file.write(struct.pack('>I', len(body)) + kind + body)
+                file.write(struct.pack('>I', zlib.crc32(kind + body)))
+
+    def close(self, frames):
+        pass
+
+
+def lzw_encode(indices, min_code_size=2):
+    """GIF flavoured LZW of a byte string of palette indices, returns the packed code stream."""
+    clear = 1 << min_code_size
+    end = clear + 1
+    out = bytearray()
+    code_size = min_code_size + 1
+    next_code = end + 1
+    codes = {}
+
+    buffer, bit_count = clear, code_size
+    prefix = indices[0]
+    for index in indices[1:]:
+        key = (prefix << 8) | index
+        code = codes.get(key)
+        if code is not None:
+            prefix = code
+            continue
+        buffer |= prefix << bit_count
+        bit_count += code_size
+        while bit_count >= 8:
+            out.append(buffer & 0xFF)
+            buffer >>= 8
+            bit_count -= 8
+        if next_code == 4096:
+            # table full, start over
+            buffer |= clear << bit_count
+            bit_count += code_size
+            codes.clear()
+            code_size = min_code_size + 1
+            next_code = end + 1
+        else:
+            if next_code >= 1 << code_size:
+                code_size += 1
+            codes[key] = next_code
+            next_code += 1
+        prefix = index
+
+    buffer |= prefix << bit_count
+    bit_count += code_size
+    # the decoder adds the last table entry on reading that code, and widens before the end code if it filled up
+    if 1 << code_size <= next_code < 4096:
+        code_size += 1
+    buffer |= end << bit_count
+    bit_count += code_size
+    while bit_count > 0:
+        out.append(buffer & 0xFF)
+        buffer >>= 8
+        bit_count -= 8
+    return bytes(out)
+
+
+class GifWriter:
+    """
+    An animated two colour GIF. Each frame only covers the rows and columns
+    that changed since the previous one, and a frame's delay is however
+    long it stayed on screen.
+    """
+    def __init__(self, path, canvas, scale, palette, frame_rate=60):
+        self.file = open(path, 'wb')
+        self.canvas = canvas
+        self.scale = scale
+        self.frame_rate = frame_rate
+        self.previous = None    # canvas rows of the last frame written
+        self.pending = None     # (rows, left, top, right, bottom) waiting for its delay
+        self.delay_written = 0  # centiseconds written so far, so rounding never drifts
+
+        canvas_width, canvas_height = canvas
+        self.file.write(b'GIF89a' + struct.pack('<HHBBB', canvas_width * scale, canvas_height * scale, 0x80, 0, 0))
+        self.file.write(b''.join(bytes(color) for color in palette))
+        # loop forever
+        self.file.write(b'\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00')
+
+    def write(self, frame, width, height, pixels):
+        canvas_width, canvas_height = self.canvas
+        rows = scale_rows(pixels, width, canvas_width // width)
+        if self.previous is None:
+            box = (0, 0, canvas_width - 1, canvas_height - 1)
+        else:
+            changed = [y for y in range(canvas_height) if rows[y] != self.previous[y]]
+            if not changed:
+                # a resolution switch that looks the same on the canvas
+                return
+            diff = 0
+            for y in changed:
+                diff |= rows[y] ^ self.previous[y]
+            box = (canvas_width - diff.bit_length(), changed[0],
+                   canvas_width - (diff & -diff).bit_length(), changed[-1])
+        self.flush(frame)
+        self.pending = (rows,) + box
+        self.previous = rows
+
+    def flush(self, frame):
+        """Writes the pending frame now that it is known to last until `frame`."""
+        if self.pending is None:
+            return
+        rows, left, top, right, bottom = self.pending
+        delay = round(frame * 100 / self.frame_rate) - self.delay_written
+        self.delay_written += delay
+
+        canvas_width = self.canvas[0]
+        scale = self.scale
+        rows = scale_rows(rows[top:bottom+1], canvas_width, scale)
+        # one index byte per pixel, cropped to the changed columns
+        image_width = (right - left + 1) * scale
+        start = left * scale
+        indices = b''.join(
+            format(line, f'0{canvas_width * scale}b').encode()[start:start+image_width] for line in rows
+        ).translate(bytes.maketrans(b'01', b'\x00\x01'))
+
+        self.file.write(struct.pack('<BBBBHBB', 0x21, 0xF9, 4, 0x04, delay, 0, 0))
+        self.file.write(struct.pack('<BHHHHB', 0x2C, left * scale, top * scale, image_width, len(rows), 0))
+        data = lzw_encode(indices)
+        self.file.write(b'\x02' + b''.join(bytes([len(data[i:i+255])]) + data[i:i+255] for i in range(0, len(data), 255)) + b'\x00')
+        self.pending = None
+
+    def close(self, frames):
+        self.flush(frames)
+        self.file.write(b'\x3b')
+        self.file.close()
+
+
+class Recorder:
+    """
+    Feeds frames to a writer on its own thread. The queue is bounded so a
+    slow encoder holds the emulator back instead of eating memory, the time
+    spent waiting for it is kept in stall_time.
+    """
+    def __init__(self, writer, queue_size=256):
+        self.writer = writer
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.last = None
+        self.frames = 0         # frames offered
+        self.written = 0        # distinct frames queued
+        self.stall_time = 0.0
+        self.error = None
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def add_frame(self, videosystem, frame):
+        """Queues the framebuffer as `frame` unless it is the same picture as the last one."""
+        self.frames += 1
+        key = (videosystem.width, videosystem.height, tuple(videosystem.pixels))
+        if key == self.last:
+            return
+        self.last = key
+        self.written += 1
+        try:
+            self.queue.put_nowait((frame,) + key)
+        except queue.Full:
+            start = time.perf_counter()
+            self.queue.put((frame,) + key)
+            self.stall_time += time.perf_counter() - start
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is None:
+                try:
+                    self.writer.write(*item)
+                except Exception as error:
+                    # keep draining so add_frame never blocks on a dead writer
+                    self.error = error
+
+    def close(self, frames):
+        """Waits for the writer to catch up and finishes the file, `frames` is where the last frame ends."""
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is None:
+            self.writer.close(frames)
+        else:
+            raise self.error
+
+
+def record_frames(cpu, recorder, frames, cycles=None):
+    """Runs the CPU uncapped for `frames` frames or `cycles` instructions, recording every frame."""
+    recorder.add_frame(cpu.videosystem, cpu.frames)
+    while cpu.running and cpu.frames < frames and (cycles is None or cpu.cycles < cycles):
+        step = cpu.cycles_to_frame_end()
+        if cycles is not None:
+            step = min(step, cycles - cpu.cycles)
+        cpu.run(step)
+        recorder.add_frame(cpu.videosystem, cpu.frames)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Record a headless run or a replay log to video.')
+    parser.add_argument('source', help='a ROM, or an input log written by replay.py')
+    parser.add_argument('output')
+    parser.add_argument('--format', choices=['raw', 'png', 'gif'],
+                        help='default is gif for .gif, raw for .raw and a PNG folder otherwise')
+    parser.add_argument('--frames', type=int, default=600, help='frames to record from a ROM')
+    parser.add_argument('--scale', type=int, default=4)
+    parser.add_argument('--engine', default='interpreter', choices=['interpreter', 'block'])
+    args = parser.parse_args()
+
+    output_format = args.format or {'.gif': 'gif', '.raw': 'raw'}.get(os.path.splitext(args.output)[1], 'png')
+
+    cycles = None
+    if args.source.endswith('.json'):
+        with open(args.source) as file:
+            log = json.load(file)
+        cpu = replay_cpu(log, args.engine)
+        cycles = log['cycles']
+        frames = float('inf')
+    else:
+        # test ROMs get their menu choices, anything else the generic game input
+        cpu = CPU(**default_quirks, **rom_quirks.get(args.source, {}), screen=None, engine=args.engine,
+                  headless=True, seed=0, input_backend=ScriptedInput(scripts.get(args.source) or game_script()))
+        cpu.load_rom(args.source)
+        frames = args.frames
+
+    canvas = (128, 64) if cpu.schip else (cpu.videosystem.width, cpu.videosystem.height)
+    palette = (cpu.base_color, cpu.draw_color)
+    if output_format == 'raw':
+        writer = RawWriter(args.output)
+    elif output_format == 'png':
+        writer = PngWriter(args.output, canvas, args.scale, palette)
+    else:
+        writer = GifWriter(args.output, canvas, args.scale, palette)
+
+    recorder = Recorder(writer)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):  # unknown opcodes print
+        record_frames(cpu, recorder, frames, cycles)
+    emulated = time.perf_counter() - start
+    recorder.close(cpu.frames)
+    elapsed = time.perf_counter() - start
+
+    print(f'{recorder.frames:,} frames, {recorder.written:,} distinct, written to {args.output}')
+    print(f'emulation {emulated:.2f}s, {recorder.stall_time:.2f}s of it waiting on the writer, '
+          f'{elapsed - emulated:.2f}s finishing the file')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
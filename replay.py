@@ -0,0 +1,134 @@
+import os
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import argparse
+import hashlib
+import json
+import sys
+import time
+
+import pygame
+
+from backends import NullInput, PygameInput
+from emulator import CPU, default_quirks
+
+# Records the keypad against the CPU's cycle count and replays it headless.
+# Together with the CPU's seeded RNG a replay reproduces the session exactly,
+# as fast as the interpreter runs.
+#
+#   python replay.py record games/BRIX brix.json
+#   python replay.py play brix.json
+
+log_version = 3
+
+
+class InputRecorder(NullInput):
+    """Passes another input backend through and logs every change of the pressed keys."""
+    def __init__(self, source):
+        self.source = source
+        self.events = []    # [cycle, keypad bitmask] whenever it changes
+        self.keypad = 0
+
+    def poll(self, cycle):
+        events = self.source.poll(cycle)
+        if self.source.keypad != self.keypad:
+            self.keypad = self.source.keypad
+            self.events.append([cycle, self.keypad])
+        return events
+
+    def wait_event(self, timeout):
+        return self.source.wait_event(timeout)
+
+
+class ReplayInput(NullInput):
+    def __init__(self, events):
+        self.events = events
+        self.position = 0
+        self.keypad = 0
+
+    def poll(self, cycle):
+        while self.position < len(self.events) and self.events[self.position][0] <= cycle:
+            self.keypad = self.events[self.position][1]
+            self.position += 1
+        return []
+
+
+def rom_hash(path):
+    with open(path, 'rb') as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+
+def record(rom, log_path, seed, quirks=default_quirks, ips=480):
+    """Plays the ROM in a window and writes the input log when the window closes."""
+    pygame.display.init()
+    recorder = InputRecorder(PygameInput())
+    cpu = CPU(**quirks, screen=None, input_backend=recorder, ips=ips, seed=seed)
+    cpu.load_rom(rom)
+    while cpu.running:
+        cpu.main_loop()
+    pygame.quit()
+
+    log = {
+        'version': log_version,
+        'rom': rom,
+        'rom_sha1': rom_hash(rom),
+        'seed': seed,
+        'quirks': quirks,
+        'ips': ips,
+        'cycles': cpu.cycles,
+        'events': recorder.events,
+    }
+    with open(log_path, 'w') as file:
+        json.dump(log, file)
+
+
+def replay_cpu(log, engine='interpreter'):
+    """A headless CPU with the session's ROM loaded and its input queued, ready to run log['cycles']."""
+    if log['version'] != log_version:
+        raise ValueError(f"unsupported input log version {log['version']}")
+    if rom_hash(log['rom']) != log['rom_sha1']:
+        raise ValueError(f"{log['rom']} is not the ROM this session was recorded with")
+
+    cpu = CPU(**log['quirks'], screen=None, engine=engine, headless=True, ips=log['ips'], seed=log['seed'],
+              input_backend=ReplayInput(log['events']))
+    cpu.load_rom(log['rom'])
+    return cpu
+
+
+def replay(log, engine='interpreter'):
+    """Re-executes a recorded session headless and uncapped, returns the CPU."""
+    cpu = replay_cpu(log, engine)
+    cpu.run(log['cycles'])
+    return cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Record a session or replay it headless.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    record_parser = commands.add_parser('record', help='play a ROM in a window and record the input')
+    record_parser.add_argument('rom')
+    record_parser.add_argument('log')
+    record_parser.add_argument('--seed', type=int, default=0)
+    play_parser = commands.add_parser('play', help='replay a recorded session headless')
+    play_parser.add_argument('log')
+    play_parser.add_argument('--engine', default='interpreter', choices=['interpreter', 'block'])
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        record(args.rom, args.log, args.seed)
+        return 0
+
+    with open(args.log) as file:
+        log = json.load(file)
+    start = time.perf_counter()
+    cpu = replay(log, args.engine)
+    elapsed = time.perf_counter() - start
+    print(f'{cpu.cycles:,} cycles, {cpu.frames:,} frames in {elapsed:.2f}s '
+          f'({cpu.cycles / elapsed:,.0f} ips, {cpu.frames / elapsed / 60:.0f}x real time)')
+    print('framebuffer', hashlib.sha1(cpu.videosystem.to_bytes()).hexdigest())
+    print('memory     ', hashlib.sha1(bytes(cpu.memory)).hexdigest())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
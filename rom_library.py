@@ -0,0 +1,185 @@
+import os
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from emulator import CPU, default_quirks
+
+# A ROM library index saved next to the launcher. Files are tracked by path
+# with their mtime and size, so unchanged files are never read again, and
+# everything learned about a ROM is stored under its content hash, so renamed
+# or copied ROMs reuse it. Thumbnails are the framebuffer after a fixed
+# number of headless cycles, rendered in a background process pool.
+#
+#   python rom_library.py games tests    index the folders and render missing thumbnails
+
+index_path = 'rom_library.json'
+# files in ROM folders that are not ROMs, save states from before they moved to their own folder
+skipped_suffixes = ('.state',)
+index_version = 2
+thumbnail_cycles = 20000
+
+# opcodes whose behaviour depends on each quirk flag
+_quirk_opcodes = {
+    'vf_reset': (0xF00F, (0x8001, 0x8002, 0x8003)),
+    'memory_i_inc': (0xF0FF, (0xF055, 0xF065)),
+    'clipping': (0xF000, (0xD000,)),
+    'shifting': (0xF00F, (0x8006, 0x800E)),
+    'jumping': (0xF000, (0xB000,)),
+}
+
+
+def file_hash(path):
+    with open(path, 'rb') as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+
+def quirk_sensitivity(path):
+    """
+    The quirk flags a ROM's code could be sensitive to at all, because it
+    contains an opcode they change. Which setting is right cannot be told
+    from the opcodes, the quirk sweep and database are for that.
+    """
+    with open(path, 'rb') as file:
+        rom = file.read()
+    # code can sit at odd addresses, so every byte offset counts
+    words = {(rom[i] << 8) | rom[i+1] for i in range(len(rom) - 1)}
+    return [flag for flag, (mask, values) in _quirk_opcodes.items()
+            if any(word & mask in values for word in words)]
+
+
+def render_thumbnail(path, cycles=thumbnail_cycles):
+    """Runs a ROM headless without input and returns its framebuffer as hex."""
+    cpu = CPU(**default_quirks, screen=None, headless=True, seed=0)
+    cpu.load_rom(path)
+    with contextlib.redirect_stdout(io.StringIO()):  # unknown opcodes print
+        cpu.run(cycles)
+    return cpu.videosystem.to_bytes().hex()
+
+
+class RomLibrary:
+    def __init__(self, path=index_path, cycles=thumbnail_cycles):
+        self.path = path
+        self.cycles = cycles
+        self.files = {}     # path -> {'mtime', 'size', 'sha1'}
+        self.roms = {}      # sha1 -> {'size', 'sensitive', 'thumbnail'}
+        self.pool = None
+        self.pending = {}   # future -> sha1
+        self.changed = False
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as file:
+                index = json.load(file)
+        except (OSError, ValueError) as error:
+            print(f'ignoring unreadable ROM index {self.path}: {error}')
+            return
+        if index.get('version') == index_version and index.get('thumbnail_cycles') == self.cycles:
+            self.files = index['files']
+            self.roms = index['roms']
+
+    def save(self):
+        index = {
+            'version': index_version,
+            'thumbnail_cycles': self.cycles,
+            'files': self.files,
+            'roms': self.roms,
+        }
+        # write a new file and swap it in, so a crash never leaves half an index
+        with open(self.path + '.tmp', 'w') as file:
+            json.dump(index, file)
+        os.replace(self.path + '.tmp', self.path)
+        self.changed = False
+
+    def scan(self, folder):
+        """
+        Returns the ROM paths in a folder, sorted. Only files whose mtime or
+        size changed are read and hashed again.
+        """
+        paths = []
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if not entry.is_file() or entry.name.startswith('.') or entry.name.endswith(skipped_suffixes):
+                    continue
+                path = os.path.join(folder, entry.name)
+                stat = entry.stat()
+                known = self.files.get(path)
+                if known is None or known['mtime'] != stat.st_mtime_ns or known['size'] != stat.st_size:
+                    self.files[path] = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'sha1': file_hash(path)}
+                    self.changed = True
+                sha1 = self.files[path]['sha1']
+                if sha1 not in self.roms:
+                    self.roms[sha1] = {'size': stat.st_size, 'sensitive': quirk_sensitivity(path), 'thumbnail': None}
+                    self.changed = True
+                paths.append(path)
+        return sorted(paths)
+
+    def entry(self, path):
+        return self.roms[self.files[path]['sha1']]
+
+    def render_missing(self, paths, workers=None):
+        """Starts rendering the thumbnails the given ROMs are missing in the background."""
+        queued = set(self.pending.values())
+        for path in paths:
+            sha1 = self.files[path]['sha1']
+            if self.roms[sha1]['thumbnail'] is None and sha1 not in queued:
+                if self.pool is None:
+                    self.pool = ProcessPoolExecutor(max_workers=workers)
+                self.pending[self.pool.submit(render_thumbnail, path, self.cycles)] = sha1
+                queued.add(sha1)
+
+    def poll(self):
+        """Collects finished thumbnails without blocking, returns the hashes that got one."""
+        finished = []
+        for future in [future for future in self.pending if future.done()]:
+            sha1 = self.pending.pop(future)
+            try:
+                self.roms[sha1]['thumbnail'] = future.result()
+            except Exception as error:
+                print(f'thumbnail for {sha1} failed: {error}')
+                continue
+            finished.append(sha1)
+            self.changed = True
+        if finished and not self.pending:
+            self.save()
+        return finished
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+        self.pending.clear()
+        if self.changed:
+            self.save()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Index ROM folders and render their thumbnails.')
+    parser.add_argument('folders', nargs='*', default=['games', 'tests'])
+    parser.add_argument('--index', default=index_path)
+    parser.add_argument('--jobs', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    library = RomLibrary(args.index)
+    paths = [path for folder in args.folders for path in library.scan(folder)]
+    library.render_missing(paths, args.jobs)
+    rendered = 0
+    while library.pending:
+        wait(library.pending, return_when=FIRST_COMPLETED)
+        rendered += len(library.poll())
+    library.close()
+    print(f'{len(paths)} ROMs indexed, {rendered} thumbnails rendered')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
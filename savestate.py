@@ -0,0 +1,142 @@
+import collections
+import hashlib
+import os
+import struct
+import zlib
+
+# Save states are a fixed header followed by the raw machine state:
+#
+#   magic, version, PC, I, DT, ST, running, cycles, frames, frame_cycles,
+#   stack depth, framebuffer width and height, XO-CHIP pitch, audio pattern set
+#   V0-VF, the SCHIP RPL flags, the audio pattern (zeros when unset),
+#   the stack, memory, the packed framebuffer
+#
+# save_state/load_state work on uncompressed bytes so a snapshot every frame
+# stays cheap, files written by write_state are zlib compressed. The F5/F9
+# hotkeys keep their files in state_dir rather than next to the ROM, where
+# the launcher would list them as ROMs.
+
+magic = b'C8SV'
+version = 2
+_header = struct.Struct('<4sBIIBB?QQHBHHB?')
+_no_pattern = bytes(16)
+state_dir = 'states'
+
+
+def save_state(cpu):
+    videosystem = cpu.videosystem
+    header = _header.pack(magic, version, cpu.PC, cpu.I, cpu.DT, cpu.ST, cpu.running,
+                          cpu.cycles, cpu.frames, cpu.frame_cycles, cpu.SP,
+                          videosystem.width, videosystem.height, cpu.pitch, cpu.audio_pattern is not None)
+    stack = struct.pack(f'<{cpu.SP}H', *cpu.stack[:cpu.SP])
+    # V and memory are bytearrays, join copies them straight into the snapshot
+    return b''.join((header, cpu.V, bytes(cpu.rpl), cpu.audio_pattern or _no_pattern, stack,
+                     cpu.memory, videosystem.to_bytes()))
+
+
+def load_state(cpu, data):
+    (state_magic, state_version, cpu.PC, cpu.I, cpu.DT, cpu.ST, cpu.running,
+     cpu.cycles, cpu.frames, cpu.frame_cycles, depth, width, height, pitch, has_pattern) = _header.unpack_from(data)
+    if state_magic != magic or state_version != version:
+        raise ValueError('not a CHIP-8 save state of a supported version')
+
+    offset = _header.size
+    cpu.V[:] = data[offset:offset+16]
+    offset += 16
+    cpu.rpl[:] = data[offset:offset+16]
+    offset += 16
+    pattern = bytes(data[offset:offset+16]) if has_pattern else None
+    offset += 16
+    # only a change reaches the audio backend, which restarts the sound
+    if (pattern, pitch) != (cpu.audio_pattern, cpu.pitch):
+        cpu.audio_pattern, cpu.pitch = pattern, pitch
+        cpu.audio_backend.set_pattern(pattern, pitch)
+    cpu.stack[:depth] = struct.unpack_from(f'<{depth}H', data, offset)
+    cpu.SP = depth
+    offset += 2*depth
+    cpu.memory[:] = data[offset:offset+len(cpu.memory)]
+    offset += len(cpu.memory)
+
+    videosystem = cpu.videosystem
+    videosystem.width, videosystem.height = width, height
+    row_bytes = width // 8
+    videosystem.pixels = [int.from_bytes(data[offset+row*row_bytes:offset+(row+1)*row_bytes], 'big')
+                          for row in range(height)]
+
+    # a key wait in progress belongs to the state that was replaced
+    cpu.key_wait = None
+
+    # memory changed underneath any translated code
+    if cpu.block_cache is not None:
+        cpu.block_cache.clear()
+
+
+def state_path(rom_path):
+    """The hotkey save state file for a ROM, its name plus a hash of where it lives so equal names do not clash."""
+    where = hashlib.sha1(os.path.abspath(rom_path).encode()).hexdigest()[:8]
+    return os.path.join(state_dir, f'{os.path.basename(rom_path)}-{where}.state')
+
+
+def write_state(cpu, path):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'wb') as file:
+        file.write(zlib.compress(save_state(cpu)))
+
+
+def read_state(cpu, path):
+    with open(path, 'rb') as file:
+        load_state(cpu, zlib.decompress(file.read()))
+
+
+class RewindBuffer:
+    """
+    A bounded ring of per-frame snapshots. Every keyframe_interval frames a
+    full compressed snapshot is kept, the frames in between are stored as
+    the compressed XOR against that keyframe, which is almost all zeros.
+    """
+    def __init__(self, seconds, frame_rate=60, keyframe_interval=60):
+        self.entries = collections.deque(maxlen=int(seconds * frame_rate))
+        self.keyframe_interval = keyframe_interval
+        self.keyframe = None        # raw bytes of the current keyframe
+        self.keyframe_blob = None   # compressed keyframe shared by its deltas
+        self.since_keyframe = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def push(self, cpu):
+        state = save_state(cpu)
+        if (self.keyframe is None or self.since_keyframe >= self.keyframe_interval
+                or len(state) != len(self.keyframe)):
+            self.keyframe = state
+            self.keyframe_blob = zlib.compress(state, 1)
+            self.since_keyframe = 0
+            self.entries.append((self.keyframe_blob, None))
+        else:
+            self.entries.append((self.keyframe_blob, zlib.compress(_xor(state, self.keyframe), 1)))
+        self.since_keyframe += 1
+
+    def rewind(self, cpu):
+        """Restores the most recent snapshot and drops it, returns False once the history is empty."""
+        if not self.entries:
+            return False
+        keyframe_blob, delta = self.entries.pop()
+        state = zlib.decompress(keyframe_blob)
+        if delta is not None:
+            state = _xor(state, zlib.decompress(delta))
+        load_state(cpu, state)
+
+        # new snapshots must not be stored as deltas against a keyframe that was rewound past
+        self.keyframe = None
+        return True
+
+    def size(self):
+        """Bytes held by the snapshots, keyframes counted once."""
+        keyframes = {id(blob): len(blob) for blob, _ in self.entries}
+        return sum(keyframes.values()) + sum(len(delta) for _, delta in self.entries if delta is not None)
+
+
+def _xor(a, b):
+    return (int.from_bytes(a, 'little') ^ int.from_bytes(b, 'little')).to_bytes(len(a), 'little')
@@ -0,0 +1,429 @@
+import os
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import argparse
+import asyncio
+import json
+import struct
+import sys
+import time
+import zlib
+
+from backends import NullInput
+from conformance import game_script, rom_quirks
+from emulator import CPU, default_quirks, frame_rate
+
+# Hosts many headless CPUs in one process and streams them to clients over
+# TCP. Every connection starts one session, and every session is a task that
+# runs one frame's worth of instructions and then yields to the others until
+# its next frame is due.
+#
+#   python server.py serve                              listen on 127.0.0.1:8642
+#   python server.py client games/BRIX --sessions 8    open 8 sessions and check the stream
+#
+# Messages are a '<IB' header, payload length and type, and the payload.
+# The client opens with a start message and then sends key events, the
+# server answers with a session message and streams frame messages. A frame
+# message is a '<IIIHHI' header, version, base version, CPU frame, width,
+# height and the CRC32 of the whole packed framebuffer, followed by the
+# zlib compressed rows that changed since the base version, each as a '<H'
+# row index and the packed row. Base version 0 is a keyframe holding every
+# row. A client that misses a version asks for a resync and gets a keyframe.
+
+protocol_version = 1
+default_port = 8642
+
+message_start = 1       # client: JSON {'rom', 'quirks', 'ips', 'seed'}
+message_session = 2     # server: JSON {'session', 'protocol', 'instructions_per_frame'}
+message_key = 3         # client: '<BB' key, pressed
+message_frame = 4       # server: framebuffer delta as above
+message_stats = 5       # client: empty request, server: JSON throughput report
+message_resync = 6      # client: empty, the next frame is a keyframe
+message_error = 7       # server: JSON {'error'}, then the connection closes
+message_end = 8         # server: empty, the CPU stopped
+
+_header = struct.Struct('<IB')
+_frame_header = struct.Struct('<IIIHHI')
+_key = struct.Struct('<BB')
+_row_index = struct.Struct('<H')
+
+# what a start message may ask for
+start_quirks = list(default_quirks) + ['schip']
+max_ips = 100000
+
+# frames are dropped for clients that fall this far behind, their next delta covers the gap
+max_buffered = 256 * 1024
+
+
+def encode_message(kind, payload=b''):
+    return _header.pack(len(payload), kind) + payload
+
+
+async def read_message(reader):
+    length, kind = _header.unpack(await reader.readexactly(_header.size))
+    return kind, await reader.readexactly(length)
+
+
+class SessionInput(NullInput):
+    """The keypad as the client last reported it."""
+    def __init__(self):
+        self.keypad = 0
+
+    def press(self, key, pressed):
+        if pressed:
+            self.keypad |= 1 << key
+        else:
+            self.keypad &= ~(1 << key)
+
+
+class Session:
+    def __init__(self, session_id, cpu, writer):
+        self.id = session_id
+        self.cpu = cpu
+        self.writer = writer
+        self.version = 0
+        self.sent = None        # (width, height, rows) the client has at self.version
+        self.bytes_sent = 0
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.ips = 0.0
+        self.started = time.perf_counter()
+        self.last_cycles = 0
+
+    def send(self, kind, payload=b''):
+        message = encode_message(kind, payload)
+        self.writer.write(message)
+        self.bytes_sent += len(message)
+
+    def frame_message(self):
+        """The delta from what the client has to the current framebuffer, None if nothing changed."""
+        videosystem = self.cpu.videosystem
+        width, height, pixels = videosystem.width, videosystem.height, videosystem.pixels
+        if self.sent is None or self.sent[:2] != (width, height):
+            rows = range(height)
+            base = 0
+        else:
+            old = self.sent[2]
+            rows = [y for y in range(height) if pixels[y] != old[y]]
+            if not rows:
+                return None
+            base = self.version
+
+        row_bytes = width // 8
+        body = b''.join(_row_index.pack(y) + pixels[y].to_bytes(row_bytes, 'big') for y in rows)
+        self.version += 1
+        self.sent = (width, height, list(pixels))
+        header = _frame_header.pack(self.version, base, self.cpu.frames, width, height,
+                                    zlib.crc32(videosystem.to_bytes()))
+        return header + zlib.compress(body, 1)
+
+    def stats(self):
+        cpu = self.cpu
+        return {
+            'session': self.id,
+            'rom': cpu.rom_path,
+            'cycles': cpu.cycles,
+            'frames': cpu.frames,
+            'ips': round(self.ips),
+            'frames_sent': self.frames_sent,
+            'frames_dropped': self.frames_dropped,
+            'bytes_sent': self.bytes_sent,
+        }
+
+
+class EmulationServer:
+    def __init__(self, rom_root='.', uncapped=False):
+        self.rom_root = os.path.realpath(rom_root)
+        self.uncapped = uncapped
+        self.sessions = {}
+        self.next_id = 1
+
+    def rom_path(self, rom):
+        """Resolves a ROM inside the ROM root, None for anything outside it."""
+        path = os.path.realpath(os.path.join(self.rom_root, rom))
+        if not path.startswith(self.rom_root + os.sep) or not os.path.isfile(path):
+            return None
+        return path
+
+    def parse_start(self, kind, payload):
+        """Checks a client's opening message, returns the ROM path and the request or raises ValueError."""
+        if kind != message_start:
+            raise ValueError('the first message must be a start message')
+        try:
+            request = json.loads(payload)
+        except ValueError:
+            raise ValueError('the start message is not valid JSON') from None
+        if not isinstance(request, dict):
+            raise ValueError('the start message must be a JSON object')
+
+        rom = request.get('rom')
+        if not isinstance(rom, str):
+            raise ValueError("'rom' must be a path string")
+        path = self.rom_path(rom)
+        if path is None:
+            raise ValueError(f"no ROM {rom!r} in the server's ROM folder")
+        quirks = request.get('quirks', {})
+        if not isinstance(quirks, dict) or any(flag not in start_quirks or not isinstance(value, bool)
+                                               for flag, value in quirks.items()):
+            raise ValueError(f"'quirks' may only set {', '.join(start_quirks)} to true or false")
+        ips = request.get('ips', 480)
+        if type(ips) is not int or not 1 <= ips <= max_ips:
+            raise ValueError(f"'ips' must be an integer from 1 to {max_ips}")
+        seed = request.get('seed')
+        if seed is not None and type(seed) is not int:
+            raise ValueError("'seed' must be an integer or null")
+        return path, request
+
+    def stats(self):
+        sessions = [session.stats() for session in self.sessions.values()]
+        return {
+            'sessions': sessions,
+            'aggregate': {
+                'sessions': len(sessions),
+                'cycles': sum(session['cycles'] for session in sessions),
+                'ips': sum(session['ips'] for session in sessions),
+                'bytes_sent': sum(session['bytes_sent'] for session in sessions),
+            },
+        }
+
+    async def handle_client(self, reader, writer):
+        session = None
+        task = None
+        try:
+            kind, payload = await read_message(reader)
+            path, request = self.parse_start(kind, payload)
+
+            quirks = dict(default_quirks, **request.get('quirks', {}))
+            cpu = CPU(**quirks, screen=None, headless=True, input_backend=SessionInput(),
+                      ips=request.get('ips', 480), seed=request.get('seed'))
+            try:
+                cpu.load_rom(path)
+            except ValueError:
+                raise ValueError(f"{request['rom']} does not fit in memory") from None
+            cpu.rom_path = request['rom']
+            session = Session(self.next_id, cpu, writer)
+            self.next_id += 1
+            self.sessions[session.id] = session
+            session.send(message_session, json.dumps({
+                'session': session.id,
+                'protocol': protocol_version,
+                'instructions_per_frame': cpu.instructions_per_frame,
+            }).encode())
+            task = asyncio.create_task(self.run_session(session))
+
+            while True:
+                kind, payload = await read_message(reader)
+                if kind == message_key:
+                    if len(payload) != _key.size:
+                        raise ValueError(f'key messages carry {_key.size} bytes, not {len(payload)}')
+                    key, pressed = _key.unpack(payload)
+                    cpu.input_backend.press(key & 0xF, pressed)
+                elif kind == message_stats:
+                    report = self.stats()
+                    report['session'] = session.stats()
+                    session.send(message_stats, json.dumps(report).encode())
+                elif kind == message_resync:
+                    session.sent = None
+        except ValueError as error:
+            # a bad request ends the connection with the reason rather than a silent close
+            writer.write(encode_message(message_error, json.dumps({'error': str(error)}).encode()))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if task is not None:
+                task.cancel()
+            if session is not None:
+                del self.sessions[session.id]
+            writer.close()
+
+    async def run_session(self, session):
+        """Runs the session's CPU a frame at a time, sending the changes after each frame."""
+        loop = asyncio.get_running_loop()
+        cpu = session.cpu
+        transport = session.writer.transport
+        frame_time = 1 / frame_rate
+        next_frame = loop.time()
+        while cpu.running:
+            cpu.input_backend.poll(cpu.cycles)
+            cpu.keypad = cpu.input_backend.keypad
+            cpu.run_frame()
+
+            if transport.get_write_buffer_size() > max_buffered:
+                session.frames_dropped += 1
+            else:
+                message = session.frame_message()
+                if message is not None:
+                    session.send(message_frame, message)
+                    session.frames_sent += 1
+
+            if self.uncapped:
+                await asyncio.sleep(0)
+            else:
+                next_frame += frame_time
+                delay = next_frame - loop.time()
+                if delay < -5 * frame_time:
+                    # too far behind, resynchronise rather than rush through the backlog
+                    next_frame = loop.time()
+                await asyncio.sleep(max(0, delay))
+
+        message = session.frame_message()
+        if message is not None:
+            session.send(message_frame, message)
+        session.send(message_end)
+
+    async def measure(self, interval):
+        """Updates every session's instructions per second each second, printing the total every `interval` seconds."""
+        last = last_print = time.perf_counter()
+        while True:
+            await asyncio.sleep(1)
+            now = time.perf_counter()
+            for session in list(self.sessions.values()):
+                cycles = session.cpu.cycles
+                session.ips = (cycles - session.last_cycles) / (now - max(last, session.started))
+                session.last_cycles = cycles
+            last = now
+            aggregate = self.stats()['aggregate']
+            if interval and now - last_print >= interval and aggregate['sessions']:
+                last_print = now
+                print(f"{aggregate['sessions']} sessions, {aggregate['ips']:,} ips, "
+                      f"{aggregate['bytes_sent']:,} bytes sent")
+
+    async def serve(self, host, port, interval):
+        server = await asyncio.start_server(self.handle_client, host, port)
+        print(f'serving ROMs from {self.rom_root} on {host}:{port}')
+        asyncio.create_task(self.measure(interval))
+        async with server:
+            await server.serve_forever()
+
+
+class ClientScreen:
+    """A client's copy of a session's framebuffer, rebuilt from frame messages."""
+    def __init__(self):
+        self.version = 0
+        self.width = self.height = 0
+        self.pixels = []
+        self.frame = 0
+        self.errors = 0
+
+    def apply(self, payload):
+        """Applies a frame message, returns False when it did not fit the copy and a resync is needed."""
+        version, base, frame, width, height, crc = _frame_header.unpack_from(payload)
+        if base != 0 and base != self.version:
+            return False
+        if base == 0:
+            self.width, self.height = width, height
+            self.pixels = [0] * height
+
+        body = zlib.decompress(payload[_frame_header.size:])
+        row_bytes = width // 8
+        step = _row_index.size + row_bytes
+        for offset in range(0, len(body), step):
+            y, = _row_index.unpack_from(body, offset)
+            self.pixels[y] = int.from_bytes(body[offset+_row_index.size:offset+step], 'big')
+        self.version = version
+        self.frame = frame
+
+        packed = b''.join(line.to_bytes(row_bytes, 'big') for line in self.pixels)
+        if zlib.crc32(packed) != crc:
+            self.errors += 1
+        return True
+
+
+async def request_stats(writer, interval=0.25):
+    # frames only arrive when the screen changes, so the client asks how far the CPU got
+    while True:
+        writer.write(encode_message(message_stats))
+        await asyncio.sleep(interval)
+
+
+async def run_client(host, port, rom, frames, keys):
+    """Plays one session until its CPU reaches `frames` frames, returns the last stats report and the client's checks."""
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(encode_message(message_start, json.dumps({'rom': rom, 'quirks': rom_quirks.get(rom, {}), 'seed': 0}).encode()))
+    poller = asyncio.create_task(request_stats(writer))
+
+    script = sorted(game_script()) if keys else []
+    screen = ClientScreen()
+    received = resyncs = 0
+    ended = False
+    try:
+        while True:
+            kind, payload = await read_message(reader)
+            if kind == message_error:
+                raise RuntimeError(json.loads(payload)['error'])
+            if kind == message_frame:
+                received += len(payload)
+                if not screen.apply(payload):
+                    resyncs += 1
+                    writer.write(encode_message(message_resync))
+                    continue
+                while script and script[0][0] <= screen.frame:
+                    _, key, pressed = script.pop(0)
+                    writer.write(encode_message(message_key, _key.pack(key, pressed)))
+            elif kind == message_end:
+                ended = True
+            elif kind == message_stats:
+                report = json.loads(payload)
+                if ended or report['session']['frames'] >= frames:
+                    break
+    finally:
+        poller.cancel()
+        writer.close()
+
+    report['client'] = {'rom': rom, 'bytes_received': received, 'versions': screen.version,
+                        'crc_errors': screen.errors, 'resyncs': resyncs}
+    return report
+
+
+async def run_clients(host, port, roms, sessions, frames, keys):
+    start = time.perf_counter()
+    reports = await asyncio.gather(*[run_client(host, port, roms[i % len(roms)], frames, keys) for i in range(sessions)])
+    elapsed = time.perf_counter() - start
+
+    for report in reports:
+        session, client = report['session'], report['client']
+        print(f"session {session['session']:>4} {client['rom']:<24} {session['frames']:>6} frames "
+              f"{client['versions']:>5} versions {client['bytes_received']:>8,} bytes "
+              f"{client['crc_errors']} crc errors {client['resyncs']} resyncs")
+    aggregate = reports[-1]['aggregate']
+    print(f"{sessions} sessions in {elapsed:.2f}s, server reports {aggregate['sessions']} sessions "
+          f"at {aggregate['ips']:,} ips")
+    return sum(report['client']['crc_errors'] for report in reports)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve CHIP-8 sessions over TCP, or test a server.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve_parser = commands.add_parser('serve', help='run the server')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=default_port)
+    serve_parser.add_argument('--roms', default='.', help='folder that ROM paths are resolved in')
+    serve_parser.add_argument('--uncapped', action='store_true', help='run sessions as fast as they go')
+    serve_parser.add_argument('--stats-interval', type=float, default=5.0, help='seconds between throughput lines, 0 for none')
+    client_parser = commands.add_parser('client', help='open sessions and check the frame stream')
+    client_parser.add_argument('roms', nargs='+')
+    client_parser.add_argument('--host', default='127.0.0.1')
+    client_parser.add_argument('--port', type=int, default=default_port)
+    client_parser.add_argument('--sessions', type=int, default=1)
+    client_parser.add_argument('--frames', type=int, default=300)
+    client_parser.add_argument('--keys', action='store_true', help='play the generic game input')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        server = EmulationServer(args.roms, args.uncapped)
+        try:
+            asyncio.run(server.serve(args.host, args.port, args.stats_interval))
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    try:
+        errors = asyncio.run(run_clients(args.host, args.port, args.roms, args.sessions, args.frames, args.keys))
+    except (RuntimeError, ConnectionError) as error:
+        print(f'client failed: {error}')
+        return 1
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
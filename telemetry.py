@@ -0,0 +1,283 @@
+import os
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import argparse
+import bisect
+import collections
+import http.server
+import json
+import sys
+import threading
+import time
+
+import pygame
+
+# Live performance numbers for a running CPU: instructions executed per
+# second, presented frames per second, the frame time distribution, time
+# slept in the scheduler and the latency from a key event to the ROM first
+# reading the key. The input backend times key events as they come off the
+# SDL queue. While the CPU waits for a key the scheduler sleeps on that
+# queue, so the time is when the key arrived. In a running frame the queue
+# is read at the next poll, and an event that came in during the clock
+# sleep is timed there, up to a frame late.
+#
+# Like the profiler, attaching swaps wrappers in and detaching puts the
+# originals back, so a CPU without telemetry runs exactly the code it always
+# runs. F3 toggles it in the emulator window, where it is drawn over the
+# game, and serve() publishes the same numbers as JSON.
+#
+#   python telemetry.py games/BRIX --port 8060
+#   curl http://127.0.0.1:8060/stats
+
+# frame time histogram buckets in ms, each counts the frames up to its edge, the last one everything slower
+histogram_edges = [8, 12, 16, 18, 20, 25, 33, 50]
+overlay_color, overlay_background = (255, 255, 255), (0, 0, 0, 170)
+
+
+def percentile(values, fraction):
+    """The value `fraction` of the way up a sorted list, None for an empty one."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class Telemetry:
+    def __init__(self, window=300):
+        self.cpu = None
+        self.frame_times = collections.deque(maxlen=window)   # seconds between the last presents
+        self.latencies = collections.deque(maxlen=32)         # seconds from a key event to the ROM seeing it
+        self.pressed_at = {}    # key -> when its key down event was taken, until Ex9E / ExA1 reads it
+        self.released_at = {}   # key -> when its key up event was taken, until Fx0A returns it
+        self.stats = {}         # refreshed once a second, shown by the overlay and the endpoint
+        self.panel = None
+
+    def attach(self, cpu):
+        self.cpu = cpu
+        self.present = cpu.videosystem.present
+        self.poll = cpu.input_backend.poll
+        self.table = cpu.dispatch
+
+        cpu.videosystem.present = self.timed_present
+        cpu.input_backend.poll = self.watched_poll
+        # the block engine inlines Ex9E / ExA1 into its blocks, so key latency is only measured interpreted
+        if cpu.block_cache is None:
+            cpu.dispatch = self.key_dispatch(self.table)
+
+        self.last_present = None
+        self.start_window(time.perf_counter())
+
+    def detach(self):
+        cpu = self.cpu
+        cpu.dispatch = self.table
+        del cpu.videosystem.present
+        del cpu.input_backend.poll
+        if hasattr(cpu.videosystem, 'screen'):
+            # repaint the whole window over the panel
+            cpu.videosystem.presented = None
+            cpu.videosystem.present()
+        self.cpu = None
+
+    def start_window(self, now):
+        cpu = self.cpu
+        self.window_start = now
+        self.window_cycles = cpu.cycles
+        self.window_idle = cpu.idle_cycles
+        self.window_sleep = cpu.scheduler.sleep_time
+        self.window_presents = 0
+
+    # key latency
+
+    def key_dispatch(self, table):
+        """A copy of the dispatch table with the keypad reading opcodes wrapped."""
+        dispatch = list(table)
+        for x in range(16):
+            for opcode in (0xE09E | x << 8, 0xE0A1 | x << 8, 0xF00A | x << 8):
+                dispatch[opcode] = self.wrap_key_handler(opcode, table[opcode])
+        return dispatch
+
+    def wrap_key_handler(self, opcode, handler):
+        x = (opcode & 0x0F00) >> 8
+        telemetry = self
+
+        if opcode & 0xF0FF == 0xF00A:
+            # Fx0A takes a key when it is released again
+            def observed(cpu):
+                handler(cpu)
+                if cpu.key_wait is None:
+                    telemetry.observe(cpu.V[x], telemetry.released_at)
+        else:
+            def observed(cpu):
+                key = cpu.V[x]
+                if (cpu.keypad >> key) & 1:
+                    telemetry.observe(key, telemetry.pressed_at)
+                handler(cpu)
+        return observed
+
+    def observe(self, key, events):
+        at = events.pop(key, None)
+        if at is not None:
+            self.latencies.append(time.perf_counter() - at)
+
+    def watched_poll(self, cycle):
+        input_backend = self.cpu.input_backend
+        before = input_backend.keypad
+        events = self.poll(cycle)
+        changed = before ^ input_backend.keypad
+        if changed:
+            now = time.perf_counter()
+            key_times = input_backend.key_times
+            for key in range(16):
+                if (changed >> key) & 1:
+                    at = key_times.get(key, now)
+                    if (input_backend.keypad >> key) & 1:
+                        self.pressed_at[key] = at
+                        self.released_at.pop(key, None)
+                    else:
+                        self.released_at[key] = at
+                        self.pressed_at.pop(key, None)
+        return events
+
+    # frames
+
+    def timed_present(self):
+        now = time.perf_counter()
+        if self.last_present is not None:
+            self.frame_times.append(now - self.last_present)
+        self.last_present = now
+        self.window_presents += 1
+        if now - self.window_start >= 1:
+            self.refresh(now)
+
+        self.present()
+        if self.panel is not None:
+            self.draw()
+
+    def refresh(self, now):
+        cpu = self.cpu
+        elapsed = now - self.window_start
+        idle = cpu.idle_cycles - self.window_idle
+        times = sorted(self.frame_times)
+        latencies = sorted(self.latencies)
+        histogram = [0] * (len(histogram_edges) + 1)
+        for frame_time in times:
+            histogram[bisect.bisect_left(histogram_edges, frame_time * 1e3)] += 1
+
+        def ms(seconds):
+            return None if seconds is None else round(seconds * 1e3, 2)
+
+        self.stats = {
+            'ips': round((cpu.cycles - self.window_cycles - idle) / elapsed),
+            'idle_ips': round(idle / elapsed),    # instructions fast-forwarded through idle loops
+            'fps': round(self.window_presents / elapsed, 1),
+            'frame_time_ms': {
+                'p50': ms(percentile(times, 0.5)),
+                'p99': ms(percentile(times, 0.99)),
+                'histogram': {f'<={edge}': count for edge, count in zip(histogram_edges, histogram)}
+                             | {f'>{histogram_edges[-1]}': histogram[-1]},
+            },
+            'sleep_fraction': round((cpu.scheduler.sleep_time - self.window_sleep) / elapsed, 3),
+            'sleep_seconds': round(cpu.scheduler.sleep_time, 3),
+            'key_latency_ms': {
+                'last': ms(self.latencies[-1] if self.latencies else None),
+                'p50': ms(percentile(latencies, 0.5)),
+                'max': ms(latencies[-1] if latencies else None),
+                'samples': len(latencies),
+            },
+            'turbo': cpu.turbo,
+            'engine': cpu.engine,
+            'frames': cpu.frames,
+        }
+        if hasattr(cpu.videosystem, 'screen'):
+            self.render(histogram)
+        self.start_window(now)
+
+    # overlay
+
+    def render(self, histogram):
+        """Builds the panel once a second, every present only blits it."""
+        if not pygame.font.get_init():
+            pygame.font.init()
+        font = pygame.font.Font(None, 20)
+        stats = self.stats
+        frame_time, latency = stats['frame_time_ms'], stats['key_latency_ms']
+        lines = [
+            f"{stats['ips']:,} ips   {stats['fps']} fps",
+            f"frame p50 {frame_time['p50']} ms   p99 {frame_time['p99']} ms",
+            f"sleeping {stats['sleep_fraction']:.0%}",
+            f"key latency {latency['last']} ms   max {latency['max']} ms"
+            if latency['samples'] else 'key latency -',
+        ]
+        labels = [font.render(line, True, overlay_color) for line in lines]
+
+        bar_width, bar_height = 14, 30
+        width = max(max(label.get_width() for label in labels), bar_width * len(histogram)) + 12
+        height = sum(label.get_height() for label in labels) + bar_height + 14
+        panel = pygame.Surface((width, height), pygame.SRCALPHA)
+        panel.fill(overlay_background)
+        y = 6
+        for label in labels:
+            panel.blit(label, (6, y))
+            y += label.get_height()
+
+        tallest = max(histogram) or 1
+        for bucket, count in enumerate(histogram):
+            bar = round(bar_height * count / tallest)
+            panel.fill(overlay_color, (6 + bucket * bar_width, y + 4 + bar_height - bar, bar_width - 2, bar))
+        self.panel = panel
+
+    def draw(self):
+        screen = self.cpu.videosystem.screen
+        rect = screen.blit(self.panel, (8, 8))
+        pygame.display.update(rect)
+
+
+class StatsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/stats':
+            self.send_error(404)
+            return
+        telemetry = self.server.cpu.telemetry
+        body = json.dumps(telemetry.stats if telemetry is not None else {'telemetry': 'off'}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(cpu, port, host='127.0.0.1'):
+    """Serves GET /stats for the CPU's telemetry from a daemon thread and returns the server."""
+    server = http.server.ThreadingHTTPServer((host, port), StatsHandler)
+    server.cpu = cpu
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    # emulator imports this module for the F3 hotkey
+    from emulator import CPU, default_quirks
+
+    parser = argparse.ArgumentParser(description='Play a ROM with telemetry on and its stats served as JSON.')
+    parser.add_argument('rom')
+    parser.add_argument('--port', type=int, default=8060)
+    parser.add_argument('--engine', default='interpreter', choices=['interpreter', 'block'])
+    args = parser.parse_args()
+
+    pygame.display.init()
+    cpu = CPU(**default_quirks, screen=None, engine=args.engine)
+    cpu.load_rom(args.rom)
+    cpu.toggle_telemetry()
+    server = serve(cpu, args.port)
+    print(f'stats on http://127.0.0.1:{args.port}/stats')
+    while cpu.running:
+        cpu.main_loop()
+    server.shutdown()
+    pygame.quit()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,412 @@
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from emulator import default_quirks, fontset, frame_rate, emu_width, emu_height
+
+# Steps N copies of one ROM in lockstep, for fuzzing and automated play-testing.
+# Every machine lives in a row of NumPy arrays. Each step fetches one opcode per
+# running machine, groups the machines by opcode kind and executes every group
+# with masked array operations, with the same semantics and quirks as
+# CPU.execute_opcode. Cxkk draws from a NumPy generator, so random ROMs do not
+# follow the same sequence as a CPU seeded with the same number.
+#
+#   python vector_engine.py games/BRIX --count 1000 --frames 600
+
+# (mask, value, kind) in the order emulator._decode_opcode tests them, 0000,
+# 0NNN and unknown opcodes all just advance
+_opcode_kinds = [
+    (0xFFFF, 0x00E0, '00E0'), (0xFFFF, 0x00EE, '00EE'),
+    (0xF000, 0x1000, '1nnn'), (0xF000, 0x2000, '2nnn'), (0xF000, 0x3000, '3xkk'), (0xF000, 0x4000, '4xkk'),
+    (0xF00F, 0x5000, '5xy0'), (0xF000, 0x6000, '6xkk'), (0xF000, 0x7000, '7xkk'),
+    (0xF00F, 0x8000, '8xy0'), (0xF00F, 0x8001, '8xy1'), (0xF00F, 0x8002, '8xy2'), (0xF00F, 0x8003, '8xy3'),
+    (0xF00F, 0x8004, '8xy4'), (0xF00F, 0x8005, '8xy5'), (0xF00F, 0x8006, '8xy6'), (0xF00F, 0x8007, '8xy7'),
+    (0xF00F, 0x800E, '8xyE'), (0xF00F, 0x9000, '9xy0'),
+    (0xF000, 0xA000, 'Annn'), (0xF000, 0xB000, 'Bnnn'), (0xF000, 0xC000, 'Cxkk'), (0xF000, 0xD000, 'Dxyn'),
+    (0xF0FF, 0xE09E, 'Ex9E'), (0xF0FF, 0xE0A1, 'ExA1'),
+    (0xF0FF, 0xF007, 'Fx07'), (0xF0FF, 0xF00A, 'Fx0A'), (0xF0FF, 0xF015, 'Fx15'), (0xF0FF, 0xF018, 'Fx18'),
+    (0xF0FF, 0xF01E, 'Fx1E'), (0xF0FF, 0xF029, 'Fx29'), (0xF0FF, 0xF033, 'Fx33'), (0xF0FF, 0xF055, 'Fx55'),
+    (0xF0FF, 0xF065, 'Fx65'),
+]
+_kind_names = ['none'] + [name for _, _, name in _opcode_kinds]
+
+def _build_kind_table():
+    opcodes = np.arange(0x10000)
+    table = np.zeros(0x10000, np.uint8)
+    # later rules only fill what earlier ones left, like the elif chain
+    for kind, (mask, value, _) in enumerate(_opcode_kinds, start=1):
+        table[((opcodes & mask) == value) & (table == 0)] = kind
+    return table
+
+_kind_table = _build_kind_table()
+
+
+def _x(opcode):
+    return (opcode >> 8) & 0xF
+
+def _y(opcode):
+    return (opcode >> 4) & 0xF
+
+
+class VectorCPU:
+    def __init__(self, count, vf_reset, memory_i_inc, clipping, shifting, jumping, ips=480, seed=None):
+        self.count = count
+        self.vf_reset = vf_reset
+        self.memory_i_inc = memory_i_inc
+        self.clipping = clipping
+        self.shifting = shifting
+        self.jumping = jumping
+        self.instructions_per_frame = max(1, round(ips / frame_rate))
+        self.rng = np.random.default_rng(seed)
+
+        self.memory = np.zeros((count, 4096), np.uint8)
+        self.memory[:, 0x50:0x50+len(fontset)] = fontset
+        self.V = np.zeros((count, 16), np.uint8)
+        self.I = np.full(count, 0x200, np.int32)
+        self.PC = np.full(count, 0x200, np.int32)
+        self.stack = np.zeros((count, 16), np.int32)
+        self.SP = np.zeros(count, np.int32)
+        self.DT = np.zeros(count, np.int32)
+        self.ST = np.zeros(count, np.int32)
+        self.framebuffer = np.zeros((count, emu_height, emu_width), bool)
+        self.running = np.ones(count, bool)
+
+        # pressed keys per machine, set by the caller between frames
+        self.keys = np.zeros((count, 16), bool)
+
+        # Fx0A in progress, like CPU.key_wait, key_wait_held and key_wait_value
+        self.key_wait = np.zeros(count, bool)
+        self.key_wait_held = np.zeros((count, 16), bool)
+        self.key_wait_value = np.full(count, -1, np.int32)
+
+        self.start_address = 0x200
+        self.pc_limit = 4096
+        self.cycles = 0
+        self.frames = 0
+
+        self.handlers = [self._op_advance] + [getattr(self, '_op_' + name) for name in _kind_names[1:]]
+
+    def load_rom(self, path):
+        with open(path, 'rb') as file:
+            rom = np.frombuffer(file.read(), np.uint8)
+        self.memory[:, self.start_address:self.start_address+len(rom)] = rom
+        self.pc_limit = min(4096, self.start_address + len(rom) + 1)
+
+    def step(self):
+        """Executes one instruction on every running machine."""
+        active = np.flatnonzero(self.running)
+        if not active.size:
+            return
+        pc = self.PC[active]
+        memory = self.memory
+        opcodes = (memory[active, pc & 0xFFF].astype(np.int32) << 8) | memory[active, (pc + 1) & 0xFFF]
+        kinds = _kind_table[opcodes]
+        for kind in np.unique(kinds):
+            select = kinds == kind
+            self.handlers[kind](active[select], opcodes[select])
+        self.cycles += 1
+
+    def run_frame(self):
+        for _ in range(self.instructions_per_frame):
+            self.step()
+        self.frames += 1
+        np.subtract(self.DT, 1, out=self.DT, where=self.DT > 0)
+        np.subtract(self.ST, 1, out=self.ST, where=self.ST > 0)
+
+    def run(self, frames):
+        for _ in range(frames):
+            self.run_frame()
+
+    def state(self, i):
+        """The machine state of instance i in the same shape as CPU.state()."""
+        rows = np.packbits(self.framebuffer[i], axis=1)
+        return {
+            'pixels': [int.from_bytes(row.tobytes(), 'big') for row in rows],
+            'V': self.V[i].tolist(),
+            'I': int(self.I[i]),
+            'PC': int(self.PC[i]),
+            'stack': self.stack[i, :self.SP[i]].tolist(),
+            'DT': int(self.DT[i]),
+            'ST': int(self.ST[i]),
+            'cycles': self.cycles,
+            'running': bool(self.running[i]),
+        }
+
+    def _advance(self, idx, step):
+        pc = self.PC[idx] + step
+        self.PC[idx] = pc
+        self.running[idx[pc >= self.pc_limit]] = False
+
+    def _skip(self, idx, condition):
+        self._advance(idx, np.where(condition, 4, 2))
+
+    # OPCODE GROUPS
+    # Every handler gets the machines that fetched this kind of opcode and
+    # their opcodes, each machine appears at most once.
+
+    def _op_advance(self, idx, opcode):
+        self._advance(idx, 2)
+
+    def _op_00E0(self, idx, opcode):
+        self.framebuffer[idx] = False
+        self._advance(idx, 2)
+
+    def _op_00EE(self, idx, opcode):
+        sp = self.SP[idx] - 1
+        underflow = sp < 0
+        self.running[idx[underflow]] = False
+        idx, sp = idx[~underflow], sp[~underflow]
+        self.SP[idx] = sp
+        self.PC[idx] = self.stack[idx, sp]
+
+    def _op_1nnn(self, idx, opcode):
+        self.PC[idx] = opcode & 0xFFF
+
+    def _op_2nnn(self, idx, opcode):
+        sp = self.SP[idx]
+        overflow = sp >= self.stack.shape[1]
+        self.running[idx[overflow]] = False
+        idx, sp, opcode = idx[~overflow], sp[~overflow], opcode[~overflow]
+        self.stack[idx, sp] = self.PC[idx] + 2
+        self.SP[idx] = sp + 1
+        self.PC[idx] = opcode & 0xFFF
+
+    def _op_3xkk(self, idx, opcode):
+        self._skip(idx, self.V[idx, _x(opcode)] == (opcode & 0xFF))
+
+    def _op_4xkk(self, idx, opcode):
+        self._skip(idx, self.V[idx, _x(opcode)] != (opcode & 0xFF))
+
+    def _op_5xy0(self, idx, opcode):
+        self._skip(idx, self.V[idx, _x(opcode)] == self.V[idx, _y(opcode)])
+
+    def _op_9xy0(self, idx, opcode):
+        self._skip(idx, self.V[idx, _x(opcode)] != self.V[idx, _y(opcode)])
+
+    def _op_6xkk(self, idx, opcode):
+        self.V[idx, _x(opcode)] = opcode & 0xFF
+        self._advance(idx, 2)
+
+    def _op_7xkk(self, idx, opcode):
+        x = _x(opcode)
+        self.V[idx, x] = (self.V[idx, x] + (opcode & 0xFF)) & 0xFF
+        self._advance(idx, 2)
+
+    def _op_8xy0(self, idx, opcode):
+        self.V[idx, _x(opcode)] = self.V[idx, _y(opcode)]
+        self._advance(idx, 2)
+
+    def _logic(self, idx, opcode, operation):
+        V = self.V
+        if self.vf_reset:
+            V[idx, 0xF] = 0
+        x = _x(opcode)
+        V[idx, x] = operation(V[idx, x], V[idx, _y(opcode)])
+        self._advance(idx, 2)
+
+    def _op_8xy1(self, idx, opcode):
+        self._logic(idx, opcode, np.bitwise_or)
+
+    def _op_8xy2(self, idx, opcode):
+        self._logic(idx, opcode, np.bitwise_and)
+
+    def _op_8xy3(self, idx, opcode):
+        self._logic(idx, opcode, np.bitwise_xor)
+
+    def _op_8xy4(self, idx, opcode):
+        V = self.V
+        x = _x(opcode)
+        total = V[idx, x].astype(np.int32) + V[idx, _y(opcode)]
+        V[idx, x] = total & 0xFF
+        V[idx, 0xF] = total > 0xFF
+        self._advance(idx, 2)
+
+    def _op_8xy5(self, idx, opcode):
+        V = self.V
+        x = _x(opcode)
+        vx, vy = V[idx, x].astype(np.int32), V[idx, _y(opcode)]
+        V[idx, x] = (vx - vy) & 0xFF
+        V[idx, 0xF] = vx >= vy
+        self._advance(idx, 2)
+
+    def _op_8xy7(self, idx, opcode):
+        V = self.V
+        x = _x(opcode)
+        vx, vy = V[idx, x].astype(np.int32), V[idx, _y(opcode)]
+        V[idx, x] = (vy - vx) & 0xFF
+        V[idx, 0xF] = vx <= vy
+        self._advance(idx, 2)
+
+    def _op_8xy6(self, idx, opcode):
+        V = self.V
+        x = _x(opcode)
+        flag = V[idx, x] & 0x1
+        source = V[idx, x] if self.shifting else V[idx, _y(opcode)]
+        V[idx, x] = source >> 1
+        V[idx, 0xF] = flag
+        self._advance(idx, 2)
+
+    def _op_8xyE(self, idx, opcode):
+        V = self.V
+        x = _x(opcode)
+        flag = V[idx, x] >> 7
+        source = V[idx, x] if self.shifting else V[idx, _y(opcode)]
+        V[idx, x] = (source.astype(np.int32) << 1) & 0xFF
+        V[idx, 0xF] = flag
+        self._advance(idx, 2)
+
+    def _op_Annn(self, idx, opcode):
+        self.I[idx] = opcode & 0xFFF
+        self._advance(idx, 2)
+
+    def _op_Bnnn(self, idx, opcode):
+        register = _x(opcode) if self.jumping else 0
+        self.PC[idx] = ((opcode & 0xFFF) + self.V[idx, register]) & 0xFFF
+
+    def _op_Cxkk(self, idx, opcode):
+        self.V[idx, _x(opcode)] = self.rng.integers(0, 256, len(idx)) & opcode & 0xFF
+        self._advance(idx, 2)
+
+    def _op_Dxyn(self, idx, opcode):
+        V = self.V
+        framebuffer = self.framebuffer
+        height, width = framebuffer.shape[1:]
+        rows = np.arange(15)
+        columns = np.arange(8)
+
+        x = V[idx, _x(opcode)].astype(np.int32) % width
+        y = V[idx, _y(opcode)].astype(np.int32) % height
+        sprites = self.memory[idx[:, None], (self.I[idx, None] + rows) & 0xFFF]
+        bits = np.unpackbits(sprites[:, :, None], axis=2).astype(bool)   # (machines, row, column)
+        bits &= rows[None, :, None] < (opcode & 0xF)[:, None, None]
+
+        pixel_x = x[:, None] + columns
+        pixel_y = y[:, None] + rows
+        if self.clipping:
+            bits &= (pixel_x < width)[:, None, :]
+            bits &= (pixel_y < height)[:, :, None]
+        pixel_x %= width
+        pixel_y %= height
+
+        # only set sprite bits are touched, so no framebuffer pixel is indexed twice
+        machine, row, column = np.nonzero(bits)
+        targets = idx[machine], pixel_y[machine, row], pixel_x[machine, column]
+        erased = framebuffer[targets]
+        framebuffer[targets] = ~erased
+
+        collision = np.zeros(len(idx), bool)
+        collision[machine[erased]] = True
+        V[idx, 0xF] = collision
+        self._advance(idx, 2)
+
+    def _pressed(self, idx, opcode):
+        key = self.V[idx, _x(opcode)]
+        return (key < 16) & self.keys[idx, key & 0xF]
+
+    def _op_Ex9E(self, idx, opcode):
+        self._skip(idx, self._pressed(idx, opcode))
+
+    def _op_ExA1(self, idx, opcode):
+        self._skip(idx, ~self._pressed(idx, opcode))
+
+    def _op_Fx07(self, idx, opcode):
+        self.V[idx, _x(opcode)] = self.DT[idx]
+        self._advance(idx, 2)
+
+    def _op_Fx0A(self, idx, opcode):
+        # a key that goes down after the wait started and comes back up, until then PC stays here
+        keys = self.keys[idx]
+        waiting = self.key_wait[idx]
+        value = self.key_wait_value[idx]
+
+        fresh = keys & ~self.key_wait_held[idx]
+        first_fresh = np.where(fresh.any(axis=1), fresh.argmax(axis=1), -1)
+        released = waiting & (value >= 0) & ~keys[np.arange(len(idx)), value & 0xF]
+
+        self.key_wait_held[idx] = keys
+        self.key_wait_value[idx] = np.where(released, -1, np.where(waiting & (value < 0), first_fresh, value))
+        self.key_wait[idx] = ~released
+
+        idx, opcode = idx[released], opcode[released]
+        self.V[idx, _x(opcode)] = value[released]
+        self._advance(idx, 2)
+
+    def _op_Fx15(self, idx, opcode):
+        self.DT[idx] = self.V[idx, _x(opcode)]
+        self._advance(idx, 2)
+
+    def _op_Fx18(self, idx, opcode):
+        self.ST[idx] = self.V[idx, _x(opcode)]
+        self._advance(idx, 2)
+
+    def _op_Fx1E(self, idx, opcode):
+        self.I[idx] = (self.I[idx] + self.V[idx, _x(opcode)]) & 0xFFF
+        self._advance(idx, 2)
+
+    def _op_Fx29(self, idx, opcode):
+        self.I[idx] = 0x50 + self.V[idx, _x(opcode)].astype(np.int32) * 5
+        self._advance(idx, 2)
+
+    def _op_Fx33(self, idx, opcode):
+        value = self.V[idx, _x(opcode)]
+        I = self.I[idx]
+        memory = self.memory
+        memory[idx, I & 0xFFF] = value // 100
+        memory[idx, (I + 1) & 0xFFF] = (value // 10) % 10
+        memory[idx, (I + 2) & 0xFFF] = value % 10
+        self._advance(idx, 2)
+
+    def _op_Fx55(self, idx, opcode):
+        x = _x(opcode)
+        I = self.I[idx]
+        for i in range(16):
+            select = x >= i
+            if not select.any():
+                break
+            self.memory[idx[select], (I[select] + i) & 0xFFF] = self.V[idx[select], i]
+        if self.memory_i_inc:
+            self.I[idx] = (I + x + 1) & 0xFFF
+        self._advance(idx, 2)
+
+    def _op_Fx65(self, idx, opcode):
+        x = _x(opcode)
+        I = self.I[idx]
+        for i in range(16):
+            select = x >= i
+            if not select.any():
+                break
+            self.V[idx[select], i] = self.memory[idx[select], (I[select] + i) & 0xFFF]
+        if self.memory_i_inc:
+            self.I[idx] = (I + x + 1) & 0xFFF
+        self._advance(idx, 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run many copies of a ROM in lockstep while mashing random keys.')
+    parser.add_argument('rom')
+    parser.add_argument('--count', type=int, default=1000)
+    parser.add_argument('--frames', type=int, default=600)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    machines = VectorCPU(args.count, **default_quirks, seed=args.seed)
+    machines.load_rom(args.rom)
+
+    start = time.perf_counter()
+    for _ in range(args.frames):
+        machines.keys = machines.rng.random((args.count, 16)) < 0.05
+        machines.run_frame()
+    elapsed = time.perf_counter() - start
+
+    instructions = machines.cycles * args.count
+    print(f'{args.count} machines, {machines.frames} frames in {elapsed:.2f}s '
+          f'({instructions / elapsed:,.0f} ips in total, {machines.running.sum()} still running)')
+    screens = np.unique(np.packbits(machines.framebuffer, axis=2).reshape(args.count, -1), axis=0)
+    print(f'{len(screens)} distinct final screens')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())